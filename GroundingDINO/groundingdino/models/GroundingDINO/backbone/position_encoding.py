@@ -94,11 +94,18 @@ class PositionEmbeddingSineHW(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # GeometryCache shared with the transformer, see GroundingDINO.set_geometry_cache
+        self.geometry_cache = None
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        if self.geometry_cache is not None:
+            key = self.geometry_cache.key([mask], tensor_list.geometry)
+            return self.geometry_cache.get(key, ("pos", tuple(mask.shape)), lambda: self.compute(mask))
+        return self.compute(mask)
+
+    def compute(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -110,11 +117,11 @@ class PositionEmbeddingSineHW(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_tx = self.temperatureW ** (2 * (torch.div(dim_tx, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_x = x_embed[:, :, :, None] / dim_tx
 
-        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_ty = self.temperatureH ** (2 * (torch.div(dim_ty, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_y = y_embed[:, :, :, None] / dim_ty
 
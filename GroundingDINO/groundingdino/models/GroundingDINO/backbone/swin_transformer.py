@@ -11,6 +11,8 @@
 # modified from https://github.com/SwinTransformer/Swin-Transformer-Object-Detection/blob/master/mmdet/models/backbones/swin_transformer.py
 # --------------------------------------------------------
 
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -340,6 +342,62 @@ class PatchMerging(nn.Module):
         return x
 
 
+# Shifted-window attention masks keyed by (Hp, Wp, window_size, shift_size, device, dtype).
+# They only depend on the padded feature size, which repeats for a fixed resize policy, so
+# they are shared by all stages, models and calls. Least recently used masks are dropped first.
+ATTN_MASK_CACHE_SIZE = 64
+_attn_mask_cache = OrderedDict()
+
+
+def compute_shifted_window_mask(Hp, Wp, window_size, shift_size, device, dtype):
+    img_mask = torch.zeros((1, Hp, Wp, 1), device=device, dtype=dtype)  # 1 Hp Wp 1
+    h_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+    w_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+        attn_mask == 0, float(0.0)
+    )
+    return attn_mask
+
+
+def get_shifted_window_mask(Hp, Wp, window_size, shift_size, device, dtype):
+    """Cached compute_shifted_window_mask. The returned nW x N x N mask is shared, do not modify it."""
+    key = (Hp, Wp, window_size, shift_size, torch.device(device), dtype)
+    attn_mask = _attn_mask_cache.get(key)
+    if attn_mask is None:
+        attn_mask = compute_shifted_window_mask(Hp, Wp, window_size, shift_size, device, dtype)
+        _attn_mask_cache[key] = attn_mask
+        while len(_attn_mask_cache) > ATTN_MASK_CACHE_SIZE:
+            _attn_mask_cache.pop(next(iter(_attn_mask_cache)), None)
+    else:
+        try:
+            _attn_mask_cache.move_to_end(key)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+    return attn_mask
+
+
+def clear_attn_mask_cache():
+    _attn_mask_cache.clear()
+
+
 class BasicLayer(nn.Module):
     """A basic Swin Transformer layer for one stage.
     Args:
@@ -406,6 +464,12 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
+    def get_attn_mask(self, H, W, device, dtype):
+        """Attention mask for SW-MSA on an H x W feature map, shared through the mask cache."""
+        Hp = int(np.ceil(H / self.window_size)) * self.window_size
+        Wp = int(np.ceil(W / self.window_size)) * self.window_size
+        return get_shifted_window_mask(Hp, Wp, self.window_size, self.shift_size, device, dtype)
+
     def forward(self, x, H, W):
         """Forward function.
         Args:
@@ -414,33 +478,7 @@ class BasicLayer(nn.Module):
         """
 
         # calculate attention mask for SW-MSA
-        Hp = int(np.ceil(H / self.window_size)) * self.window_size
-        Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device, dtype=x.dtype)  # 1 Hp Wp 1
-        h_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        w_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(
-            img_mask, self.window_size
-        )  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
-            attn_mask == 0, float(0.0)
-        )
+        attn_mask = self.get_attn_mask(H, W, x.device, x.dtype)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -675,6 +713,24 @@ class SwinTransformer(nn.Module):
     #     else:
     #         raise TypeError('pretrained must be a str or None')
 
+    def precompute_attn_masks(self, image_sizes, device=None, dtype=None):
+        """Fills the shifted-window mask cache for a known set of input resolutions.
+
+        Args:
+            image_sizes: iterable of (H, W) sizes of the (padded) input images.
+            device, dtype: those of the features, default to the patch embedding's parameters.
+        """
+        weight = self.patch_embed.proj.weight
+        device = weight.device if device is None else device
+        dtype = weight.dtype if dtype is None else dtype
+        patch_h, patch_w = self.patch_embed.patch_size
+        for H, W in image_sizes:
+            Wh, Ww = -(-H // patch_h), -(-W // patch_w)
+            for layer in self.layers:
+                layer.get_attn_mask(Wh, Ww, device, dtype)
+                if layer.downsample is not None:
+                    Wh, Ww = (Wh + 1) // 2, (Ww + 1) // 2
+
     def forward_raw(self, x):
         """Forward function."""
         x = self.patch_embed(x)
@@ -749,7 +805,7 @@ class SwinTransformer(nn.Module):
             m = tensor_list.mask
             assert m is not None
             mask = F.interpolate(m[None].float(), size=out_i.shape[-2:]).to(torch.bool)[0]
-            outs_dict[idx] = NestedTensor(out_i, mask)
+            outs_dict[idx] = NestedTensor(out_i, mask, tensor_list.geometry)
 
         return outs_dict
 
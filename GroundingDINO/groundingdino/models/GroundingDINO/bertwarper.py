@@ -185,86 +185,67 @@ def generate_masks_with_special_tokens(tokenized, special_tokens_list, tokenizer
     Returns:
         torch.Tensor: attention mask between each special tokens.
     """
-    input_ids = tokenized["input_ids"]
-    bs, num_token = input_ids.shape
-    # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
-    for special_token in special_tokens_list:
-        special_tokens_mask |= input_ids == special_token
-
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
-
-    # generate attention mask and positional ids
-    attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    attention_mask, position_ids, _ = generate_masks_with_special_tokens_and_transfer_map(
+        tokenized, special_tokens_list, tokenizer, with_cate_to_token=False
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
+    return attention_mask, position_ids
 
-        previous_col = col
 
-    # # padding mask
-    # padding_mask = tokenized['attention_mask']
-    # attention_mask = attention_mask & padding_mask.unsqueeze(1).bool() & padding_mask.unsqueeze(2).bool()
-
-    return attention_mask, position_ids.to(torch.long)
-
-
-def generate_masks_with_special_tokens_and_transfer_map(tokenized, special_tokens_list, tokenizer):
+def generate_masks_with_special_tokens_and_transfer_map(
+    tokenized, special_tokens_list, tokenizer, with_cate_to_token=True
+):
     """Generate attention mask between each pair of special tokens
+    Every special token closes a segment made of the tokens after the previous special token
+    up to and including itself. Tokens attend to their own segment and their position ids count
+    from 0 within it. Special tokens at the first and last position, and the tokens after the
+    last closing special token (e.g. padding), only attend to themselves with position id 0.
     Args:
         input_ids (torch.Tensor): input ids. Shape: [bs, num_token]
         special_tokens_mask (list): special tokens mask.
+        with_cate_to_token (bool): also build cate_to_token_mask_list, None otherwise.
     Returns:
         torch.Tensor: attention mask between each special tokens.
+        torch.Tensor: position ids. Shape: [bs, num_token]
+        list: per sample, a [num_cate, num_token] mask of the tokens of each category.
     """
     input_ids = tokenized["input_ids"]
     bs, num_token = input_ids.shape
+    device = input_ids.device
     # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    special_tokens_mask = torch.zeros((bs, num_token), device=device).bool()
     for special_token in special_tokens_list:
         special_tokens_mask |= input_ids == special_token
+    # a special token in the last position does not close a segment
+    special_tokens_mask[:, -1] = False
 
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
+    # segment_ids: number of closing special tokens before each token
+    num_closed = special_tokens_mask.cumsum(1)
+    segment_ids = num_closed - special_tokens_mask.long()
+    closed = segment_ids < num_closed[:, -1:]  # bs, num_token
 
     # generate attention mask and positional ids
     attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+        (segment_ids[:, :, None] == segment_ids[:, None, :])
+        & closed[:, :, None]
+        & closed[:, None, :]
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    cate_to_token_mask_list = [[] for _ in range(bs)]
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
-            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
-            c2t_maski[previous_col + 1 : col] = True
-            cate_to_token_mask_list[row].append(c2t_maski)
-        previous_col = col
-
-    cate_to_token_mask_list = [
-        torch.stack(cate_to_token_mask_listi, dim=0)
-        for cate_to_token_mask_listi in cate_to_token_mask_list
-    ]
+    attention_mask |= torch.eye(num_token, device=device).bool().unsqueeze(0)
+
+    token_idx = torch.arange(num_token, device=device).expand(bs, -1)
+    last_special = torch.where(special_tokens_mask, token_idx, -1).cummax(1)[0]
+    segment_start = torch.cat([last_special.new_zeros((bs, 1)), last_special[:, :-1] + 1], 1)
+    position_ids = torch.where(closed, token_idx - segment_start, 0)
+
+    cate_to_token_mask_list = None
+    if with_cate_to_token:
+        # one category per closing special token, except in the first position
+        rows, cols = torch.nonzero(special_tokens_mask & (token_idx > 0), as_tuple=True)
+        cate_to_token_mask = (segment_ids[rows] == segment_ids[rows, cols][:, None]) & ~(
+            special_tokens_mask[rows]
+        )
+        cate_to_token_mask_list = list(
+            torch.split(cate_to_token_mask, torch.bincount(rows, minlength=bs).tolist())
+        )
 
     # # padding mask
     # padding_mask = tokenized['attention_mask']
@@ -8,28 +8,172 @@
 **************************************************************************************************
 */
 
+#include <cmath>
 #include <vector>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
 
 namespace groundingdino {
 
+// Adds weight * bilinear(value, h, w) to out, for one head of one level.
+// Same sampling rule as ms_deform_attn_im2col_bilinear in the CUDA kernel,
+// i.e. grid_sample with align_corners=False and zero padding.
+template <typename scalar_t>
+static inline void ms_deform_attn_cpu_bilinear_accumulate(
+    const scalar_t* value,
+    const int height,
+    const int width,
+    const int64_t value_stride,
+    const int channels,
+    const scalar_t h,
+    const scalar_t w,
+    const scalar_t weight,
+    scalar_t* out)
+{
+  const int h_low = static_cast<int>(std::floor(h));
+  const int w_low = static_cast<int>(std::floor(w));
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h - h_low;
+  const scalar_t lw = w - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+
+  const scalar_t corner_weights[4] = {hh * hw * weight, hh * lw * weight, lh * hw * weight, lh * lw * weight};
+  const int corner_h[4] = {h_low, h_low, h_high, h_high};
+  const int corner_w[4] = {w_low, w_high, w_low, w_high};
+
+  for (int corner = 0; corner < 4; ++corner)
+  {
+    const int ch = corner_h[corner];
+    const int cw = corner_w[corner];
+    if (ch < 0 || cw < 0 || ch > height - 1 || cw > width - 1)
+    {
+      continue;
+    }
+    const scalar_t cweight = corner_weights[corner];
+    const scalar_t* ptr = value + (static_cast<int64_t>(ch) * width + cw) * value_stride;
+    for (int c = 0; c < channels; ++c)
+    {
+      out[c] += cweight * ptr[c];
+    }
+  }
+}
+
+template <typename scalar_t>
+static void ms_deform_attn_cpu_forward_kernel(
+    const scalar_t* value,
+    const int64_t* spatial_shapes,
+    const int64_t* level_start_index,
+    const scalar_t* sampling_loc,
+    const scalar_t* attn_weight,
+    const int batch,
+    const int spatial_size,
+    const int num_heads,
+    const int channels,
+    const int num_levels,
+    const int num_query,
+    const int num_point,
+    scalar_t* output)
+{
+  const int64_t value_stride = static_cast<int64_t>(num_heads) * channels;
+  const int64_t num_tasks = static_cast<int64_t>(batch) * num_query * num_heads;
+
+  // one task per (batch, query, head): gather every level and point and accumulate in a single pass
+  at::parallel_for(0, num_tasks, 16, [&](int64_t begin, int64_t end) {
+    for (int64_t index = begin; index < end; ++index)
+    {
+      const int m = index % num_heads;
+      const int b = index / num_heads / num_query;
+
+      scalar_t* out = output + index * channels;
+      for (int c = 0; c < channels; ++c)
+      {
+        out[c] = 0;
+      }
+
+      const scalar_t* loc = sampling_loc + index * num_levels * num_point * 2;
+      const scalar_t* weight = attn_weight + index * num_levels * num_point;
+
+      for (int l = 0; l < num_levels; ++l)
+      {
+        const int height = spatial_shapes[l * 2];
+        const int width = spatial_shapes[l * 2 + 1];
+        const scalar_t* value_l =
+            value + ((static_cast<int64_t>(b) * spatial_size + level_start_index[l]) * num_heads + m) * channels;
+
+        for (int p = 0; p < num_point; ++p)
+        {
+          const scalar_t h_im = loc[1] * height - 0.5;
+          const scalar_t w_im = loc[0] * width - 0.5;
+          const scalar_t w = *weight;
+          loc += 2;
+          weight += 1;
+
+          if (h_im > -1 && w_im > -1 && h_im < height && w_im < width)
+          {
+            ms_deform_attn_cpu_bilinear_accumulate(
+                value_l, height, width, value_stride, channels, h_im, w_im, w, out);
+          }
+        }
+      }
+    }
+  });
+}
+
 at::Tensor
 ms_deform_attn_cpu_forward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
     const at::Tensor &attn_weight,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(!spatial_shapes.is_cuda(), "spatial_shapes must be a CPU tensor");
+    AT_ASSERTM(!level_start_index.is_cuda(), "level_start_index must be a CPU tensor");
+    AT_ASSERTM(!sampling_loc.is_cuda(), "sampling_loc must be a CPU tensor");
+    AT_ASSERTM(!attn_weight.is_cuda(), "attn_weight must be a CPU tensor");
+
+    // im2col_step only bounds the CUDA column buffer, the CPU kernel needs no buffer
+    const auto value_c = value.contiguous();
+    const auto spatial_shapes_c = spatial_shapes.to(at::kLong).contiguous();
+    const auto level_start_index_c = level_start_index.to(at::kLong).contiguous();
+    const auto sampling_loc_c = sampling_loc.contiguous();
+    const auto attn_weight_c = attn_weight.contiguous();
+
+    const int batch = value_c.size(0);
+    const int spatial_size = value_c.size(1);
+    const int num_heads = value_c.size(2);
+    const int channels = value_c.size(3);
+
+    const int num_levels = spatial_shapes_c.size(0);
+
+    const int num_query = sampling_loc_c.size(1);
+    const int num_point = sampling_loc_c.size(4);
+
+    auto output = at::empty({batch, num_query, num_heads * channels}, value_c.options());
+
+    AT_DISPATCH_FLOATING_TYPES(value_c.scalar_type(), "ms_deform_attn_cpu_forward", ([&] {
+        ms_deform_attn_cpu_forward_kernel<scalar_t>(
+            value_c.data_ptr<scalar_t>(),
+            spatial_shapes_c.data_ptr<int64_t>(),
+            level_start_index_c.data_ptr<int64_t>(),
+            sampling_loc_c.data_ptr<scalar_t>(),
+            attn_weight_c.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels,
+            num_levels, num_query, num_point,
+            output.data_ptr<scalar_t>());
+    }));
+
+    return output;
 }
 
 std::vector<at::Tensor>
 ms_deform_attn_cpu_backward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
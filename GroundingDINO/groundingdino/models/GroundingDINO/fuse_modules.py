@@ -124,6 +124,9 @@ class BiMultiHeadAttention(nn.Module):
         self.clamp_min_for_underflow = True
         self.clamp_max_for_overflow = True
 
+        # peak memory of the attention weights at inference in MB, None materialises them at once
+        self.memory_budget_mb = None
+
         self._reset_parameters()
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
@@ -171,6 +174,20 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
+        chunk_size = self._chunk_size(bsz, tgt_len, src_len, query_states.element_size())
+        if chunk_size < tgt_len:
+            attn_output_v, attn_output_l = self._chunked_attention(
+                query_states,
+                key_states,
+                value_v_states,
+                value_l_states,
+                bsz,
+                chunk_size,
+                attention_mask_v,
+                attention_mask_l,
+            )
+            return self._output(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))  # bs*nhead, nimg, ntxt
 
         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
@@ -234,6 +251,9 @@ class BiMultiHeadAttention(nn.Module):
                 f"`attn_output_l` should be of size {(bsz, self.num_heads, src_len, self.head_dim)}, but is {attn_output_l.size()}"
             )
 
+        return self._output(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
+    def _output(self, attn_output_v, attn_output_l, bsz, tgt_len, src_len):
         attn_output_v = attn_output_v.view(bsz, self.num_heads, tgt_len, self.head_dim)
         attn_output_v = attn_output_v.transpose(1, 2)
         attn_output_v = attn_output_v.reshape(bsz, tgt_len, self.embed_dim)
@@ -247,6 +267,102 @@ class BiMultiHeadAttention(nn.Module):
 
         return attn_output_v, attn_output_l
 
+    def _clamp(self, attn_weights):
+        if self.clamp_min_for_underflow:
+            attn_weights = torch.clamp(attn_weights, min=-50000)
+        if self.clamp_max_for_overflow:
+            attn_weights = torch.clamp(attn_weights, max=50000)
+        return attn_weights
+
+    def _chunk_size(self, bsz, tgt_len, src_len, element_size):
+        """Number of image tokens per chunk that keeps the attention weights within the budget."""
+        if self.memory_budget_mb is None or (self.training and self.dropout > 0):
+            return tgt_len
+        # about four chunk-sized weight tensors are alive at once
+        bytes_per_token = 4 * bsz * self.num_heads * src_len * element_size
+        return max(1, int(self.memory_budget_mb * 2**20) // bytes_per_token)
+
+    def _chunked_attention(
+        self,
+        query_states,
+        key_states,
+        value_v_states,
+        value_l_states,
+        bsz,
+        chunk_size,
+        attention_mask_v=None,
+        attention_mask_l=None,
+    ):
+        """Same result as the full path, tiled over the image tokens.
+
+        A first pass over the chunks finds the maxima of every language row, from which the
+        global maximum of stable_softmax_2d follows. With those exact maxima the clamps keep
+        their meaning, the vision->language output is computed chunk by chunk and the
+        language->vision softmax is streamed: its numerator and denominator are accumulated
+        over the chunks and divided at the end.
+        """
+        num_heads = self.num_heads
+        tgt_len = query_states.shape[1]
+        chunks = [slice(start, start + chunk_size) for start in range(0, tgt_len, chunk_size)]
+        if attention_mask_l is not None:
+            # bs, 1, 1, ntxt, broadcast over heads instead of repeating
+            attention_mask_l = attention_mask_l[:, None, None, :]
+
+        # pass 1: maxima over all and over the unpadded image tokens of every language row
+        row_max = valid_row_max = None
+        for idx in chunks:
+            attn_weights = torch.bmm(query_states[:, idx], key_states.transpose(1, 2))
+            chunk_max = attn_weights.max(1)[0]  # bs*nhead, ntxt
+            if attention_mask_v is not None:
+                attn_weights = attn_weights.view(bsz, num_heads, *attn_weights.shape[1:])
+                mask_v = attention_mask_v[:, None, idx, None]
+                attn_weights = attn_weights.masked_fill(mask_v, float("-inf")).flatten(0, 1)
+                chunk_valid_max = attn_weights.max(1)[0]
+            else:
+                chunk_valid_max = chunk_max
+            if row_max is None:
+                row_max, valid_row_max = chunk_max, chunk_valid_max
+            else:
+                row_max = torch.maximum(row_max, chunk_max)
+                valid_row_max = torch.maximum(valid_row_max, chunk_valid_max)
+
+        # the clamps and the shifts commute with max, so these are the maxima of the shifted weights
+        global_max = row_max.max() if self.stable_softmax_2d else None
+        if global_max is not None:
+            row_max = row_max - global_max
+            valid_row_max = valid_row_max - global_max
+        row_max = self._clamp(row_max).unsqueeze(-1)  # bs*nhead, ntxt, 1
+        # softmax subtracts the maximum of its unmasked inputs
+        softmax_shift = self._clamp(self._clamp(valid_row_max).unsqueeze(-1) - row_max)
+
+        # pass 2
+        attn_output_v = []
+        numerator_l = torch.zeros_like(value_l_states, dtype=value_v_states.dtype)
+        denominator_l = torch.zeros_like(row_max)
+        for idx in chunks:
+            attn_weights = torch.bmm(query_states[:, idx], key_states.transpose(1, 2))
+            if global_max is not None:
+                attn_weights = attn_weights - global_max
+            attn_weights = self._clamp(attn_weights)  # bs*nhead, chunk, ntxt
+
+            # language for vision: the weights of this chunk's language rows
+            attn_weights_l = self._clamp(attn_weights.transpose(1, 2) - row_max)
+            if attention_mask_v is not None:
+                mask_v = attention_mask_v[:, None, None, idx]
+                attn_weights_l = attn_weights_l.view(bsz, num_heads, *attn_weights_l.shape[1:])
+                attn_weights_l = attn_weights_l.masked_fill(mask_v, float("-inf")).flatten(0, 1)
+            attn_weights_l = (attn_weights_l - softmax_shift).exp()
+            denominator_l += attn_weights_l.sum(-1, keepdim=True)
+            numerator_l += torch.bmm(attn_weights_l, value_v_states[:, idx])
+
+            # vision for language: complete within the chunk
+            if attention_mask_l is not None:
+                attn_weights = attn_weights.view(bsz, num_heads, *attn_weights.shape[1:])
+                attn_weights = attn_weights.masked_fill(attention_mask_l, float("-inf")).flatten(0, 1)
+            attn_output_v.append(torch.bmm(attn_weights.softmax(dim=-1), value_l_states))
+
+        return torch.cat(attn_output_v, 1), numerator_l / denominator_l
+
 
 # Bi-Direction MHA (text->image, image->text)
 class BiAttentionBlock(nn.Module):
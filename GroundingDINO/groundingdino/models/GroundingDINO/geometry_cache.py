@@ -0,0 +1,83 @@
+# ------------------------------------------------------------------------
+# Grounding DINO
+# url: https://github.com/IDEA-Research/GroundingDINO
+# Copyright (c) 2023 IDEA. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import torch
+from torch import Tensor
+
+
+class GeometryCache:
+    """
+    Memoises the tensors of a forward pass that only depend on the padding masks: the sine
+    position embedding of each level, the encoder proposal anchors, the encoder reference
+    points, the valid ratios and the spatial shapes.
+
+    Entries are keyed by the input geometry, i.e. the padded size of the batch and the
+    unpadded size of every image, read from the host-side NestedTensor.geometry that
+    nested_tensor_from_tensor_list records. The masks at every level are derived from it, so
+    one entry holds the tensors of all the levels and of the transformer, and max_entries
+    counts input geometries. Without a geometry the sizes are read back from the masks, which
+    costs a device sync per lookup, and every mask list gets its own entry; such masks are
+    expected to pad at the bottom and the right, and masks that are not a top-left rectangle
+    are never cached. The cached tensors are shared between calls and must not be modified
+    in place.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def key(self, masks: List[Tensor], geometry: Optional[tuple] = None) -> Optional[tuple]:
+        """Returns the cache key of a list of bs x H x W padding masks derived from the input
+        batch described by 'geometry' (see NestedTensor.geometry), without a device sync. The
+        key is the same for every level of that batch, so the names stored under it must tell
+        the levels apart. Falls back to masks_key when the geometry is unknown."""
+        if geometry is None:
+            return self.masks_key(masks)
+        return (masks[0].device, geometry)
+
+    def masks_key(self, masks: List[Tensor]) -> Optional[tuple]:
+        """Returns the cache key of a list of bs x H x W padding masks, with a single device sync,
+        or None if a mask is not a top-left rectangle."""
+        extents = torch.cat(
+            [
+                torch.stack([(~m[:, :, 0]).sum(1), (~m[:, 0, :]).sum(1), (~m).flatten(1).sum(1)], 1)
+                for m in masks
+            ]
+        ).tolist()
+        if any(valid_h * valid_w != num_valid for valid_h, valid_w, num_valid in extents):
+            return None
+        shapes = tuple(tuple(m.shape) for m in masks)
+        return (masks[0].device, shapes, tuple((h, w) for h, w, _ in extents))
+
+    def get(self, key: Optional[tuple], name, compute: Callable[[], object]):
+        """Returns the value stored under 'name' for 'key', computing it on a miss."""
+        if key is None:
+            return compute()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        if name not in entry:
+            self.misses += 1
+            entry[name] = compute()
+        else:
+            self.hits += 1
+        return entry[name]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
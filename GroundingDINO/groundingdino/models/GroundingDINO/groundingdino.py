@@ -15,7 +15,8 @@
 # Copyright (c) 2020 SenseTime. All Rights Reserved.
 # ------------------------------------------------------------------------
 import copy
-from typing import List
+from collections import OrderedDict
+from typing import Dict, List
 
 import torch
 import torch.nn.functional as F
@@ -44,6 +45,8 @@ from .bertwarper import (
     generate_masks_with_special_tokens,
     generate_masks_with_special_tokens_and_transfer_map,
 )
+from .fuse_modules import BiMultiHeadAttention
+from .geometry_cache import GeometryCache
 from .transformer import build_transformer
 from .utils import MLP, ContrastiveEmbed, sigmoid_focal_loss
 
@@ -75,6 +78,10 @@ class GroundingDINO(nn.Module):
         text_encoder_type="bert-base-uncased",
         sub_sentence_present=True,
         max_text_len=256,
+        text_cache_size=16,
+        final_layer_only=False,
+        geometry_cache_size=0,
+        fusion_memory_budget_mb=None,
     ):
         """Initializes the model.
         Parameters:
@@ -83,6 +90,12 @@ class GroundingDINO(nn.Module):
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          Conditional DETR can detect in a single image. For COCO, we recommend 100 queries.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            text_cache_size: number of encoded captions kept at inference time, 0 disables the cache.
+            final_layer_only: only compute the outputs of the last decoder layer, see set_final_layer_only.
+            geometry_cache_size: number of input geometries whose mask-only tensors are kept,
+                                 0 disables the cache, see set_geometry_cache.
+            fusion_memory_budget_mb: peak memory of the vision-language attention weights at
+                                     inference, see set_fusion_memory_budget.
         """
         super().__init__()
         self.num_queries = num_queries
@@ -119,6 +132,10 @@ class GroundingDINO(nn.Module):
         # special tokens
         self.specical_tokens = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]", ".", "?"])
 
+        # LRU cache of encoded captions, only used at inference time
+        self.text_cache_size = text_cache_size
+        self.text_cache = OrderedDict()
+
         # prepare input projection layers
         if num_feature_levels > 1:
             num_backbone_outs = len(backbone.num_channels)
@@ -178,6 +195,9 @@ class GroundingDINO(nn.Module):
         self.class_embed = nn.ModuleList(class_embed_layerlist)
         self.transformer.decoder.bbox_embed = self.bbox_embed
         self.transformer.decoder.class_embed = self.class_embed
+        self.set_final_layer_only(final_layer_only)
+        self.set_geometry_cache(geometry_cache_size)
+        self.set_fusion_memory_budget(fusion_memory_budget_mb)
 
         # two stage
         self.two_stage_type = two_stage_type
@@ -210,37 +230,130 @@ class GroundingDINO(nn.Module):
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, self.query_dim)
 
-    def forward(self, samples: NestedTensor, targets: List = None, **kw):
-        """The forward expects a NestedTensor, which consists of:
-           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
-           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+    def encode_text(self, captions: List[str], device=None) -> Dict[str, torch.Tensor]:
+        """Tokenizes the captions and runs them through BERT and feat_map.
 
-        It returns a dict with the following elements:
-           - "pred_logits": the classification logits (including no-object) for all queries.
-                            Shape= [batch_size x num_queries x num_classes]
-           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                           (center_x, center_y, width, height). These values are normalized in [0, 1],
-                           relative to the size of each individual image (disregarding possible padding).
-                           See PostProcess for information on how to retrieve the unnormalized bounding box.
-           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                            dictionnaries containing the two above keys for each decoder layer.
+        At inference time (eval mode, gradients disabled) the result is kept in an
+        LRU cache keyed by caption, so that a prompt shared by a whole job pays the
+        BERT cost once. A batch that repeats one caption is encoded once and
+        replicated along the batch dimension.
+
+        Returns a dict with "encoded_text" (bs, n_text, d_model), "text_token_mask"
+        (bs, n_text), "position_ids" (bs, n_text) and "text_self_attention_masks"
+        (bs, n_text, n_text), which can also be passed to forward as text_dict.
         """
-        if targets is None:
-            captions = kw["captions"]
+        use_cache = self.text_cache_size > 0 and not self.training and not torch.is_grad_enabled()
+        if not use_cache:
+            return self._encode_text(captions, device)
+
+        bs = len(captions)
+        repeated = all(caption == captions[0] for caption in captions)
+        key = (captions[0] if repeated else tuple(captions), str(device))
+
+        text_dict = self.text_cache.get(key)
+        if text_dict is None:
+            text_dict = self._encode_text(captions[:1] if repeated else captions, device)
+            self.text_cache[key] = text_dict
+            while len(self.text_cache) > self.text_cache_size:
+                self.text_cache.popitem(last=False)
         else:
-            captions = [t["caption"] for t in targets]
-        len(captions)
+            self.text_cache.move_to_end(key)
+
+        if repeated and bs > 1:
+            text_dict = {k: v.repeat(bs, *([1] * (v.dim() - 1))) for k, v in text_dict.items()}
+        return dict(text_dict)
+
+    def clear_text_cache(self):
+        self.text_cache.clear()
 
+    def set_geometry_cache(self, max_entries=8):
+        """Memoises the tensors that only depend on the padding masks.
+
+        The sine position embeddings, valid ratios, encoder reference points and proposal
+        anchors are recomputed for every image although they only depend on the image sizes,
+        which repeat for a fixed resize policy. They are kept for the last max_entries input
+        geometries (padded batch size and image sizes, every level included) in a GeometryCache
+        shared by the position embedding and the transformer. max_entries=0 disables the cache.
+        """
+        self.geometry_cache = GeometryCache(max_entries) if max_entries > 0 else None
+        self.transformer.geometry_cache = self.geometry_cache
+        position_embedding = self.backbone[1]
+        if hasattr(position_embedding, "geometry_cache"):
+            position_embedding.geometry_cache = self.geometry_cache
+        return self
+
+    def set_inference_mode(self):
+        """Strips activation checkpointing from the Swin backbone and the encoder.
+
+        Checkpointing re-runs layers in the backward pass to save memory. At inference
+        there is no backward pass, yet every checkpoint call still stashes RNG states and
+        goes through an autograd Function, so the layers are called directly instead.
+        """
+        for module in self.modules():
+            if hasattr(module, "use_checkpoint"):
+                module.use_checkpoint = False
+            if hasattr(module, "use_transformer_ckpt"):
+                module.use_transformer_ckpt = False
+        self.set_final_layer_only(True)
+        return self
+
+    def set_final_layer_only(self, final_layer_only=True):
+        """Only computes the outputs of the last decoder layer.
+
+        Inference only reads pred_logits and pred_boxes, which come from the last layer.
+        The class logits, boxes and output norm of the other layers, and the box
+        refinement after the last one, only feed the auxiliary losses and are skipped.
+        """
+        self.final_layer_only = final_layer_only
+        self.transformer.decoder.final_layer_only = final_layer_only
+        return self
+
+    def set_adaptive_queries(
+        self, min_queries=None, max_queries=None, score_threshold=0.05, prune_threshold=None
+    ):
+        """Decodes fewer than num_queries proposals at inference.
+
+        Instead of the fixed top num_queries encoder proposals, K proposals are decoded, K being
+        the number whose encoder score exceeds score_threshold, clamped to [min_queries,
+        max_queries]. With prune_threshold, queries whose class score falls below it are also
+        dropped between decoder layers (this needs final_layer_only). Both trade recall for
+        latency, see benchmarks/bench_adaptive_queries.py. Call with min_queries=None to restore
+        the fixed num_queries proposals.
+        """
+        if min_queries is None:
+            self.transformer.adaptive_queries = None
+            self.transformer.decoder.prune_threshold = None
+            return self
+        assert prune_threshold is None or self.final_layer_only, "query pruning needs final_layer_only"
+        max_queries = self.num_queries if max_queries is None else max_queries
+        self.transformer.adaptive_queries = (min_queries, max_queries, score_threshold)
+        self.transformer.decoder.prune_threshold = prune_threshold
+        self.transformer.decoder.min_queries = min_queries
+        return self
+
+    def set_fusion_memory_budget(self, memory_budget_mb=None):
+        """Bounds the memory of the bidirectional vision-language attention at inference.
+
+        The feature enhancer materialises bs*nheads x n_img x n_text attention weights and
+        several copies of them. With a budget, BiMultiHeadAttention tiles the image tokens
+        so that the weights of a tile stay within memory_budget_mb, with the same result.
+        None restores the single-shot computation.
+        """
+        for module in self.modules():
+            if isinstance(module, BiMultiHeadAttention):
+                module.memory_budget_mb = memory_budget_mb
+        return self
+
+    def _encode_text(self, captions: List[str], device=None) -> Dict[str, torch.Tensor]:
         # encoder texts
-        tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
-        )
+        tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(device)
+        # the category to token map is only used by the training losses
         (
             text_self_attention_masks,
             position_ids,
             cate_to_token_mask_list,
         ) = generate_masks_with_special_tokens_and_transfer_map(
-            tokenized, self.specical_tokens, self.tokenizer
+            tokenized, self.specical_tokens, self.tokenizer, with_cate_to_token=self.training
         )
 
         if text_self_attention_masks.shape[1] > self.max_text_len:
@@ -283,8 +396,75 @@ class GroundingDINO(nn.Module):
             "text_self_attention_masks": text_self_attention_masks,  # bs, 195,195
         }
 
+        return text_dict
+
+    def forward(self, samples: NestedTensor, targets: List = None, **kw):
+        """The forward expects a NestedTensor, which consists of:
+           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+        It returns a dict with the following elements:
+           - "pred_logits": the classification logits (including no-object) for all queries.
+                            Shape= [batch_size x num_queries x num_classes]
+           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
+                           (center_x, center_y, width, height). These values are normalized in [0, 1],
+                           relative to the size of each individual image (disregarding possible padding).
+                           See PostProcess for information on how to retrieve the unnormalized bounding box.
+           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+                            dictionnaries containing the two above keys for each decoder layer.
+
+        At inference, the text features can be passed precomputed as text_dict=self.encode_text(captions).
+        """
+        if targets is None:
+            captions = kw["captions"]
+        else:
+            captions = [t["caption"] for t in targets]
+
+        # encoder texts, unless the caller passes them precomputed
+        text_dict = kw.get("text_dict")
+        if text_dict is None:
+            text_dict = self.encode_text(captions, samples.device)
+        # the transformer replaces "encoded_text" in place, keep the caller's dict intact
+        text_dict = dict(text_dict)
+
         # import ipdb; ipdb.set_trace()
 
+        if isinstance(samples, (list, torch.Tensor)):
+            samples = nested_tensor_from_tensor_list(samples)
+        srcs, masks, poss = self.encode_image(samples)
+        return self.forward_heads(srcs, masks, poss, text_dict, samples.geometry)
+
+    def forward_captions(self, samples: NestedTensor, captions: List[str]):
+        """Evaluates several independent captions on each image with a single backbone pass.
+
+        The backbone and the input projections run once per image. Their outputs are then
+        replicated along the batch dimension, one copy per caption, and only the feature
+        enhancer, the decoder and the heads run on the bs * len(captions) batch. The outputs
+        are those of forward, ordered image-major: entry i * len(captions) + j answers
+        captions[j] on image i.
+        """
+        if isinstance(samples, (list, torch.Tensor)):
+            samples = nested_tensor_from_tensor_list(samples)
+        srcs, masks, poss = self.encode_image(samples)
+
+        bs, num_captions = samples.tensors.shape[0], len(captions)
+        geometry = samples.geometry
+        if num_captions > 1:
+            srcs, masks, poss = (
+                [x.repeat_interleave(num_captions, dim=0) for x in xs] for xs in (srcs, masks, poss)
+            )
+            if geometry is not None:
+                padded_size, image_sizes = geometry
+                geometry = (padded_size, tuple(s for s in image_sizes for _ in range(num_captions)))
+        text_dict = self.encode_text(list(captions) * bs, samples.device)
+        return self.forward_heads(srcs, masks, poss, text_dict, geometry)
+
+    def encode_image(self, samples: NestedTensor):
+        """Runs the backbone and the input projections.
+
+        Returns the per-level projected features [bs, hidden_dim, hi, wi], padding masks
+        [bs, hi, wi] and position embeddings [bs, hidden_dim, hi, wi].
+        """
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
         features, poss = self.backbone(samples)
@@ -305,16 +485,26 @@ class GroundingDINO(nn.Module):
                     src = self.input_proj[l](srcs[-1])
                 m = samples.mask
                 mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
-                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+                pos_l = self.backbone[1](NestedTensor(src, mask, samples.geometry)).to(src.dtype)
                 srcs.append(src)
                 masks.append(mask)
                 poss.append(pos_l)
+        return srcs, masks, poss
 
+    def forward_heads(self, srcs, masks, poss, text_dict, geometry=None):
+        """Runs the transformer and the heads on the outputs of encode_image, see forward.
+        geometry is the NestedTensor.geometry of the batch, used to key the GeometryCache."""
         input_query_bbox = input_query_label = attn_mask = dn_meta = None
         hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(
-            srcs, masks, input_query_bbox, poss, input_query_label, attn_mask, text_dict
+            srcs, masks, input_query_bbox, poss, input_query_label, attn_mask, text_dict, geometry=geometry
         )
 
+        if self.final_layer_only:
+            # hs and reference only hold the last decoder layer and its input reference points
+            outputs_class = self.class_embed[-1](hs[-1], text_dict)
+            outputs_coord = self.bbox_embed[-1](hs[-1]) + inverse_sigmoid(reference[-1])
+            return {"pred_logits": outputs_class, "pred_boxes": outputs_coord.sigmoid()}
+
         # deformable-detr-like anchor update
         outputs_coord_list = []
         for dec_lid, (layer_ref_sig, layer_bbox_embed, layer_hs) in enumerate(
@@ -363,6 +553,15 @@ class GroundingDINO(nn.Module):
 @MODULE_BUILD_FUNCS.registe_with_name(module_name="groundingdino")
 def build_groundingdino(args):
 
+    if getattr(args, "inference_mode", False):
+        # activation checkpointing only pays off when gradients are kept
+        args.use_checkpoint = False
+        args.use_transformer_ckpt = False
+        # the auxiliary outputs of the intermediate decoder layers only feed the losses
+        args.final_layer_only = True
+        if 'geometry_cache_size' not in args:
+            args.geometry_cache_size = 8
+
     backbone = build_backbone(args)
     transformer = build_transformer(args)
 
@@ -370,6 +569,10 @@ def build_groundingdino(args):
     dec_pred_bbox_embed_share = args.dec_pred_bbox_embed_share
     sub_sentence_present = args.sub_sentence_present
     bert_base_uncased_path = args.bert_base_uncased_path if 'bert_base_uncased_path' in args else None
+    text_cache_size = args.text_cache_size if 'text_cache_size' in args else 16
+    final_layer_only = args.final_layer_only if 'final_layer_only' in args else False
+    geometry_cache_size = args.geometry_cache_size if 'geometry_cache_size' in args else 0
+    fusion_memory_budget_mb = args.fusion_memory_budget_mb if 'fusion_memory_budget_mb' in args else None
 
     model = GroundingDINO(
         backbone,
@@ -393,6 +596,10 @@ def build_groundingdino(args):
         text_encoder_type=args.text_encoder_type,
         sub_sentence_present=sub_sentence_present,
         max_text_len=args.max_text_len,
+        text_cache_size=text_cache_size,
+        final_layer_only=final_layer_only,
+        geometry_cache_size=geometry_cache_size,
+        fusion_memory_budget_mb=fusion_memory_budget_mb,
     )
 
     return model
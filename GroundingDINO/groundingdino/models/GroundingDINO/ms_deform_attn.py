@@ -28,6 +28,7 @@ from torch.nn.init import constant_, xavier_uniform_
 try:
     from groundingdino import _C
 except:
+    _C = None
     warnings.warn("Failed to load custom C++ ops. Running on CPU mode Only!")
 
 
@@ -38,6 +39,23 @@ def _is_power_of_2(n):
     return (n & (n - 1) == 0) and n != 0
 
 
+def _use_cpu_kernel(value, sampling_locations, attention_weights):
+    """Whether the compiled CPU kernel can replace multi_scale_deformable_attn_pytorch.
+
+    The CPU kernel has no backward, so it is only used when no gradient is needed.
+    """
+    if _C is None or value.is_cuda:
+        return False
+    if value.dtype not in (torch.float32, torch.float64):
+        return False
+    if sampling_locations.dtype != value.dtype or attention_weights.dtype != value.dtype:
+        return False
+    return not (
+        torch.is_grad_enabled()
+        and (value.requires_grad or sampling_locations.requires_grad or attention_weights.requires_grad)
+    )
+
+
 class MultiScaleDeformableAttnFunction(Function):
     @staticmethod
     def forward(
@@ -346,6 +364,16 @@ class MultiScaleDeformableAttention(nn.Module):
 
             if halffloat:
                 output = output.half()
+        elif _use_cpu_kernel(value, sampling_locations, attention_weights):
+            # single-pass multithreaded kernel, forward only
+            output = _C.ms_deform_attn_forward(
+                value,
+                spatial_shapes,
+                level_start_index,
+                sampling_locations,
+                attention_weights,
+                self.im2col_step,
+            )
         else:
             output = multi_scale_deformable_attn_pytorch(
                 value, spatial_shapes, sampling_locations, attention_weights
@@ -16,6 +16,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 # ------------------------------------------------------------------------
 
+import os
+import warnings
 from typing import Optional
 
 import torch
@@ -32,6 +34,7 @@ from .utils import (
     _get_activation_fn,
     _get_clones,
     gen_encoder_output_proposals,
+    gen_encoder_proposal_anchors,
     gen_sineembed_for_position,
     get_sine_pos_embed,
 )
@@ -184,6 +187,11 @@ class Transformer(nn.Module):
         self.enc_out_class_embed = None
         self.enc_out_bbox_embed = None
 
+        # (min_queries, max_queries, score_threshold) at inference, see GroundingDINO.set_adaptive_queries
+        self.adaptive_queries = None
+        # GeometryCache for the mask-only tensors, see GroundingDINO.set_geometry_cache
+        self.geometry_cache = None
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -205,10 +213,30 @@ class Transformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    @staticmethod
+    def get_spatial_shapes(spatial_shapes, device):
+        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=device)
+        level_start_index = torch.cat(
+            (spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1])
+        )
+        return spatial_shapes, level_start_index
+
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, 4)
 
-    def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, text_dict=None):
+    def cached(self, geometry_key, name, compute):
+        if self.geometry_cache is None:
+            return compute()
+        return self.geometry_cache.get(geometry_key, name, compute)
+
+    def select_num_queries(self, topk_logits):
+        """Number of proposals to decode: those whose encoder score passes the threshold in any
+        image of the batch, clamped to [min_queries, max_queries]. Costs one device sync."""
+        min_queries, max_queries, score_threshold = self.adaptive_queries
+        num_confident = (topk_logits.sigmoid() > score_threshold).sum(1).max().item()
+        return int(min(max(num_confident, min_queries), max_queries, self.num_queries))
+
+    def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, text_dict=None, geometry=None):
         """
         Input:
             - srcs: List of multi features [bs, ci, hi, wi]
@@ -216,8 +244,11 @@ class Transformer(nn.Module):
             - refpoint_embed: [bs, num_dn, 4]. None in infer
             - pos_embeds: List of multi pos embeds [bs, ci, hi, wi]
             - tgt: [bs, num_dn, d_model]. None in infer
+            - geometry: NestedTensor.geometry of the input batch, None if unknown
 
         """
+        geometry_key = self.geometry_cache.key(masks, geometry) if self.geometry_cache is not None else None
+
         # prepare input for encoder
         src_flatten = []
         mask_flatten = []
@@ -241,13 +272,21 @@ class Transformer(nn.Module):
         src_flatten = torch.cat(src_flatten, 1)  # bs, \sum{hxw}, c
         mask_flatten = torch.cat(mask_flatten, 1)  # bs, \sum{hxw}
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)  # bs, \sum{hxw}, c
-        spatial_shapes = torch.as_tensor(
-            spatial_shapes, dtype=torch.long, device=src_flatten.device
+        spatial_shapes, level_start_index = self.cached(
+            geometry_key, "spatial_shapes", lambda: self.get_spatial_shapes(spatial_shapes, src_flatten.device)
         )
-        level_start_index = torch.cat(
-            (spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1])
+        valid_ratios = self.cached(
+            geometry_key,
+            ("valid_ratios", src.dtype),
+            lambda: torch.stack([self.get_valid_ratio(m) for m in masks], 1).to(src.dtype),
         )
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1).to(src.dtype)
+        reference_points = None
+        if self.geometry_cache is not None:
+            reference_points = self.cached(
+                geometry_key,
+                ("encoder_reference_points", src.dtype),
+                lambda: self.encoder.get_reference_points(spatial_shapes, valid_ratios, src.device),
+            )
 
         # two stage
         enc_topk_proposals = enc_refpoint_embed = None
@@ -267,6 +306,7 @@ class Transformer(nn.Module):
             # we ~ the mask . False means use the token; True means pad the token
             position_ids=text_dict["position_ids"],
             text_self_attention_masks=text_dict["text_self_attention_masks"],
+            reference_points=reference_points,
         )
         #########################################################
         # End Encoder
@@ -282,8 +322,13 @@ class Transformer(nn.Module):
         #         import ipdb; ipdb.set_trace()
 
         if self.two_stage_type == "standard":
+            anchors = self.cached(
+                geometry_key,
+                "proposal_anchors",
+                lambda: gen_encoder_proposal_anchors(mask_flatten, spatial_shapes),
+            )
             output_memory, output_proposals = gen_encoder_output_proposals(
-                memory, mask_flatten, spatial_shapes
+                memory, mask_flatten, spatial_shapes, anchors=anchors
             )
             output_memory = self.enc_output_norm(self.enc_output(output_memory))
 
@@ -297,6 +342,8 @@ class Transformer(nn.Module):
                 self.enc_out_bbox_embed(output_memory) + output_proposals
             )  # (bs, \sum{hw}, 4) unsigmoid
             topk = self.num_queries
+            if self.adaptive_queries is not None and not self.training:
+                topk = self.select_num_queries(topk_logits)
 
             topk_proposals = torch.topk(topk_logits, topk, dim=1)[1]  # bs, nq
 
@@ -315,7 +362,7 @@ class Transformer(nn.Module):
             )
             if self.embed_init_tgt:
                 tgt_ = (
-                    self.tgt_embed.weight[:, None, :].repeat(1, bs, 1).transpose(0, 1)
+                    self.tgt_embed.weight[:topk, None, :].repeat(1, bs, 1).transpose(0, 1)
                 )  # nq, bs, d_model
             else:
                 tgt_ = tgt_undetach.detach()
@@ -494,6 +541,7 @@ class TransformerEncoder(nn.Module):
         pos_text: Tensor = None,
         text_self_attention_masks: Tensor = None,
         position_ids: Tensor = None,
+        reference_points: Tensor = None,
     ):
         """
         Input:
@@ -510,6 +558,7 @@ class TransformerEncoder(nn.Module):
             - pos_text: bs, n_text, 256
 
             - position_ids: bs, n_text
+            - reference_points: precomputed get_reference_points(spatial_shapes, valid_ratios), optional
         Intermedia:
             - reference_points: [bs, sum(hi*wi), num_level, 2]
         Outpus:
@@ -519,7 +568,7 @@ class TransformerEncoder(nn.Module):
         output = src
 
         # preparation and reshape
-        if self.num_layers > 0:
+        if self.num_layers > 0 and reference_points is None:
             reference_points = self.get_reference_points(
                 spatial_shapes, valid_ratios, device=src.device
             )
@@ -631,6 +680,19 @@ class TransformerDecoder(nn.Module):
 
         self.ref_anchor_head = None
 
+        # only return the last layer's output and the reference points it was run with,
+        # see GroundingDINO.final_layer_only
+        self.final_layer_only = False
+
+        # count NaN/Inf in every layer's output and report them once per forward. The counts
+        # stay on device until the end, so this costs a single sync instead of one per layer
+        self.check_numerics = os.environ.get("GROUNDINGDINO_CHECK_NUMERICS") == "1"
+
+        # drop the queries whose best class score falls below prune_threshold between layers,
+        # keeping at least min_queries. Inference only, see GroundingDINO.set_adaptive_queries
+        self.prune_threshold = None
+        self.min_queries = 1
+
     def forward(
         self,
         tgt,
@@ -656,12 +718,17 @@ class TransformerDecoder(nn.Module):
             - pos: hw, bs, d_model
             - refpoints_unsigmoid: nq, bs, 2/4
             - valid_ratios/spatial_shapes: bs, nlevel, 2
+        Output:
+            - intermediate: n_dec x [bs, nq, d_model], or 1 x [bs, nq, d_model] with final_layer_only
+            - ref_points: (n_dec+1) x [bs, nq, query_dim], or 1 x [bs, nq, query_dim] with
+              final_layer_only (the reference points fed to the last layer)
         """
         output = tgt
 
         intermediate = []
         reference_points = refpoints_unsigmoid.sigmoid()
         ref_points = [reference_points]
+        nonfinite_counts = []
 
         for layer_id, layer in enumerate(self.layers):
 
@@ -702,16 +769,14 @@ class TransformerDecoder(nn.Module):
                 self_attn_mask=tgt_mask,
                 cross_attn_mask=memory_mask,
             )
-            if output.isnan().any() | output.isinf().any():
-                print(f"output layer_id {layer_id} is nan")
-                try:
-                    num_nan = output.isnan().sum().item()
-                    num_inf = output.isinf().sum().item()
-                    print(f"num_nan {num_nan}, num_inf {num_inf}")
-                except Exception as e:
-                    print(e)
-                    # if os.environ.get("SHILONG_AMP_INFNAN_DEBUG") == '1':
-                    #     import ipdb; ipdb.set_trace()
+            if self.check_numerics:
+                nonfinite_counts.append(torch.stack([output.isnan().sum(), output.isinf().sum()]))
+
+            if self.final_layer_only and layer_id == self.num_layers - 1:
+                # the refinement after the last layer is only consumed by the training losses
+                intermediate.append(self.norm(output))
+                ref_points = [reference_points]
+                break
 
             # iter update
             if self.bbox_embed is not None:
@@ -728,13 +793,42 @@ class TransformerDecoder(nn.Module):
                 # if layer_id != self.num_layers - 1:
                 ref_points.append(new_reference_points)
 
-            intermediate.append(self.norm(output))
+            if self.prune_threshold is not None and self.final_layer_only and not self.training:
+                output, reference_points = self.prune_queries(
+                    layer_id, output, reference_points, memory_text, text_attention_mask
+                )
+
+            if not self.final_layer_only:
+                intermediate.append(self.norm(output))
+
+        if nonfinite_counts:
+            self.report_numerics(nonfinite_counts)
 
         return [
             [itm_out.transpose(0, 1) for itm_out in intermediate],
             [itm_refpoint.transpose(0, 1) for itm_refpoint in ref_points],
         ]
 
+    def prune_queries(self, layer_id, output, reference_points, memory_text, text_attention_mask):
+        """Keeps the queries whose best class score after this layer reaches prune_threshold in
+        any image of the batch, in their original order. Costs one device sync per layer."""
+        text_dict = {"encoded_text": memory_text, "text_token_mask": ~text_attention_mask}
+        logits = self.class_embed[layer_id](self.norm(output).transpose(0, 1), text_dict)
+        scores = logits.sigmoid().max(-1)[0].max(0)[0]  # nq
+        keep = (scores >= self.prune_threshold).nonzero()[:, 0]
+        if keep.numel() < self.min_queries:
+            keep = scores.topk(min(self.min_queries, scores.numel()))[1].sort()[0]
+        return output[keep], reference_points[keep]
+
+    @staticmethod
+    def report_numerics(nonfinite_counts):
+        # the only host sync of the numerics guard
+        for layer_id, (num_nan, num_inf) in enumerate(torch.stack(nonfinite_counts).tolist()):
+            if num_nan or num_inf:
+                warnings.warn(
+                    f"output layer_id {layer_id} is not finite: num_nan {num_nan}, num_inf {num_inf}", RuntimeWarning
+                )
+
 
 class DeformableTransformerEncoderLayer(nn.Module):
     def __init__(
@@ -54,7 +54,7 @@ def get_sine_pos_embed(
 
 
 def gen_encoder_output_proposals(
-    memory: Tensor, memory_padding_mask: Tensor, spatial_shapes: Tensor, learnedwh=None
+    memory: Tensor, memory_padding_mask: Tensor, spatial_shapes: Tensor, learnedwh=None, anchors=None
 ):
     """
     Input:
@@ -62,11 +62,38 @@ def gen_encoder_output_proposals(
         - memory_padding_mask: bs, \sum{hw}
         - spatial_shapes: nlevel, 2
         - learnedwh: 2
+        - anchors: precomputed gen_encoder_proposal_anchors(memory_padding_mask, spatial_shapes)
     Output:
         - output_memory: bs, \sum{hw}, d_model
         - output_proposals: bs, \sum{hw}, 4
     """
-    N_, S_, C_ = memory.shape
+    if anchors is None:
+        anchors = gen_encoder_proposal_anchors(memory_padding_mask, spatial_shapes, learnedwh)
+    output_proposals, output_proposals_valid = anchors
+
+    output_memory = memory
+    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
+    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
+
+    # output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
+    # output_memory = output_memory.masked_fill(~output_proposals_valid, float('inf'))
+
+    output_proposals = output_proposals.to(output_memory.dtype)
+    return output_memory, output_proposals
+
+
+def gen_encoder_proposal_anchors(memory_padding_mask: Tensor, spatial_shapes: Tensor, learnedwh=None):
+    """
+    Input:
+        - memory_padding_mask: bs, \sum{hw}
+        - spatial_shapes: nlevel, 2
+        - learnedwh: 2
+    Output:
+        - output_proposals: bs, \sum{hw}, 4, unsigmoid, inf where padded or invalid
+        - output_proposals_valid: bs, \sum{hw}, 1
+    """
+    N_ = memory_padding_mask.shape[0]
+    device = memory_padding_mask.device
     proposals = []
     _cur = 0
     for lvl, (H_, W_) in enumerate(spatial_shapes):
@@ -77,8 +104,8 @@ def gen_encoder_output_proposals(
         # import ipdb; ipdb.set_trace()
 
         grid_y, grid_x = torch.meshgrid(
-            torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-            torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device),
+            torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=device),
+            torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=device),
         )
         grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)  # H_, W_, 2
 
@@ -105,16 +132,7 @@ def gen_encoder_output_proposals(
     output_proposals = torch.log(output_proposals / (1 - output_proposals))  # unsigmoid
     output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float("inf"))
     output_proposals = output_proposals.masked_fill(~output_proposals_valid, float("inf"))
-
-    output_memory = memory
-    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
-    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
-
-    # output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
-    # output_memory = output_memory.masked_fill(~output_proposals_valid, float('inf'))
-
-    output_proposals = output_proposals.to(output_memory.dtype)
-    return output_memory, output_proposals
+    return output_proposals, output_proposals_valid
 
 
 class RandomBoxPerturber:
@@ -1,18 +1,19 @@
+from functools import lru_cache
 from typing import Tuple, List
 
-import re
 import cv2
 import numpy as np
 import supervision as sv
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from torchvision.ops import box_convert
 
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
-from groundingdino.util.utils import get_phrases_from_posmap
+from groundingdino.util.utils import build_token_class_table, get_class_ids_from_logits, get_phrases_from_posmap
 
 # ----------------------------------------------------------------------------------------------------------------------
 # OLD API
@@ -26,9 +27,16 @@ def preprocess_caption(caption: str) -> str:
     return result + "."
 
 
-def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda"):
+def load_model(
+        model_config_path: str,
+        model_checkpoint_path: str,
+        device: str = "cuda",
+        inference_mode: bool = True
+):
     args = SLConfig.fromfile(model_config_path)
     args.device = device
+    # build without activation checkpointing, which only adds overhead without a backward pass
+    args.inference_mode = inference_mode
     model = build_model(args)
     checkpoint = torch.load(model_checkpoint_path, map_location="cpu")
     model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
@@ -50,6 +58,84 @@ def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     return image, image_transformed
 
 
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+# largest difference to the PIL path, in uint8 levels divided by the smallest std: PIL and the
+# torch uint8 kernel both round to uint8 after each of their two passes, which keeps each of
+# them within one level of the exact resize, and their fixed-point weights add up to one more
+PREPROCESS_TOLERANCE = 3.0 / (255 * min(IMAGE_STD)) + 1e-4
+
+
+@lru_cache(maxsize=None)
+def cpu_resizes_uint8() -> bool:
+    """Whether the CPU antialiased bilinear interpolation takes uint8 input (torch >= 2.1)."""
+    try:
+        F.interpolate(
+            torch.zeros(1, 3, 4, 4, dtype=torch.uint8), size=(2, 2), mode="bilinear", align_corners=False, antialias=True
+        )
+    except (RuntimeError, NotImplementedError):
+        return False
+    return True
+
+
+def preprocess_images(
+        images_bgr: List[np.ndarray],
+        device: str = "cpu",
+        size: int = 800,
+        max_size: int = 1333,
+        pin_memory: bool = False
+) -> List[torch.Tensor]:
+    """
+    Tensor-native version of Model.preprocess_image for a list of HxWx3 uint8 BGR
+    images: each one is resized with the RandomResize([800], max_size=1333) rule,
+    converted to RGB and normalized, without going through PIL. The uint8 pixels
+    are uploaded to `device` first and the resize runs there, as an antialiased
+    bilinear interpolation like PIL's, followed by a single multiply-add that
+    does the BGR->RGB swap, the /255 and the mean/std normalization. Images of
+    the same shape are resized together in one call. The resize runs on uint8 on
+    CPUs whose torch supports it (see cpu_resizes_uint8) and on float otherwise.
+    The output stays within PREPROCESS_TOLERANCE of Model.preprocess_image, i.e.
+    three uint8 levels after normalization, and matches it exactly on most pixels.
+
+    pin_memory: with a CPU device the results are page-locked, so that a later
+    .to("cuda", non_blocking=True) overlaps with compute; with a CUDA device the
+    uint8 upload is staged through page-locked memory instead.
+    """
+    device = torch.device(device)
+    on_cuda = device.type == "cuda"
+    resize_uint8 = not on_cuda and cpu_resizes_uint8()
+    scale = torch.tensor([1.0 / (255.0 * s) for s in IMAGE_STD], device=device).view(1, 3, 1, 1)
+    shift = torch.tensor([-m / s for m, s in zip(IMAGE_MEAN, IMAGE_STD)], device=device).view(1, 3, 1, 1)
+
+    groups = {}
+    for i, image in enumerate(images_bgr):
+        groups.setdefault(image.shape, []).append(i)
+
+    results = [None] * len(images_bgr)
+    for (h, w, _), indices in groups.items():
+        batch = torch.from_numpy(np.stack([images_bgr[i] for i in indices]))
+        if pin_memory and on_cuda:
+            batch = batch.pin_memory()
+        batch = batch.to(device, non_blocking=on_cuda).permute(0, 3, 1, 2)
+        out_h, out_w = T.get_size_with_aspect_ratio((w, h), size, max_size)
+        if (out_h, out_w) != (h, w):
+            # the CPU kernel of torch >= 2.1 resizes channels-last uint8 directly and rounds like PIL
+            batch = F.interpolate(
+                batch if resize_uint8 else batch.float(),
+                size=(out_h, out_w),
+                mode="bilinear",
+                align_corners=False,
+                antialias=True,
+            )
+        # channel flip folded into the normalization: RGB = BGR[:, ::-1]
+        batch = torch.addcmul(shift, batch.flip(1), scale).contiguous()
+        if pin_memory and not on_cuda:
+            batch = batch.pin_memory()
+        for i, image in zip(indices, batch):
+            results[i] = image
+    return results
+
+
 def predict(
         model,
         image: torch.Tensor,
@@ -69,12 +155,174 @@ def predict(
     prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
     prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
 
+    tokenizer = model.tokenizer
+    tokenized = tokenizer(caption)
+
+    return select_predictions(
+        prediction_logits=prediction_logits,
+        prediction_boxes=prediction_boxes,
+        tokenized=tokenized,
+        tokenizer=tokenizer,
+        box_threshold=box_threshold,
+        text_threshold=text_threshold)
+
+
+def predict_batch(
+        model,
+        images: List[torch.Tensor],
+        caption: str,
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda"
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    Runs a single forward pass over a list of differently sized images with the
+    same caption. The images are padded into one NestedTensor, whose mask keeps
+    the padding out of attention, and the predicted boxes stay normalized to
+    each image's own size. Returns one (boxes, logits, phrases) per image.
+    """
+    caption = preprocess_caption(caption=caption)
+
+    model = model.to(device)
+    samples = nested_tensor_from_tensor_list([image.to(device) for image in images])
+
+    with torch.no_grad():
+        outputs = model(samples, captions=[caption] * len(images))
+
+    prediction_logits = outputs["pred_logits"].cpu().sigmoid()  # prediction_logits.shape = (bs, nq, 256)
+    prediction_boxes = outputs["pred_boxes"].cpu()  # prediction_boxes.shape = (bs, nq, 4)
+
+    tokenizer = model.tokenizer
+    tokenized = tokenizer(caption)
+
+    return [
+        select_predictions(
+            prediction_logits=image_logits,
+            prediction_boxes=image_boxes,
+            tokenized=tokenized,
+            tokenizer=tokenizer,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold)
+        for image_logits, image_boxes
+        in zip(prediction_logits, prediction_boxes)
+    ]
+
+
+def predict_captions(
+        model,
+        image: torch.Tensor,
+        captions: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda"
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    Evaluates several independent captions on one image. The backbone runs once and
+    only the text-dependent part of the model is replicated per caption, see
+    GroundingDINO.forward_captions. Returns one (boxes, logits, phrases) per caption.
+    """
+    captions = [preprocess_caption(caption=caption) for caption in captions]
+
+    model = model.to(device)
+    image = image.to(device)
+
+    with torch.no_grad():
+        outputs = model.forward_captions(image[None], captions)
+
+    prediction_logits = outputs["pred_logits"].cpu().sigmoid()  # prediction_logits.shape = (n_captions, nq, 256)
+    prediction_boxes = outputs["pred_boxes"].cpu()  # prediction_boxes.shape = (n_captions, nq, 4)
+
+    tokenizer = model.tokenizer
+    return [
+        select_predictions(
+            prediction_logits=caption_logits,
+            prediction_boxes=caption_boxes,
+            tokenized=tokenizer(caption),
+            tokenizer=tokenizer,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold)
+        for caption, caption_logits, caption_boxes
+        in zip(captions, prediction_logits, prediction_boxes)
+    ]
+
+
+def predict_classes(
+        model,
+        images: List[torch.Tensor],
+        classes: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda"
+) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """
+    Like predict_batch with the caption ". ".join(classes), but instead of decoding a
+    phrase per box it returns the class ids directly, see select_class_predictions.
+    Returns one (boxes, logits, class_ids) per image.
+    """
+    caption = preprocess_caption(caption=". ".join(classes))
+
+    model = model.to(device)
+    samples = nested_tensor_from_tensor_list([image.to(device) for image in images])
+
+    with torch.no_grad():
+        outputs = model(samples, captions=[caption] * len(images))
+
+    prediction_logits = outputs["pred_logits"].cpu().sigmoid()  # prediction_logits.shape = (bs, nq, 256)
+    prediction_boxes = outputs["pred_boxes"].cpu()  # prediction_boxes.shape = (bs, nq, 4)
+
+    token_classes = token_class_table(model.tokenizer, caption, len(classes))
+
+    return [
+        select_class_predictions(
+            prediction_logits=image_logits,
+            prediction_boxes=image_boxes,
+            token_classes=token_classes,
+            num_classes=len(classes),
+            box_threshold=box_threshold,
+            text_threshold=text_threshold)
+        for image_logits, image_boxes
+        in zip(prediction_logits, prediction_boxes)
+    ]
+
+
+@lru_cache(maxsize=32)
+def token_class_table(tokenizer, caption: str, num_classes: int) -> torch.Tensor:
+    """Token -> class id table of a caption, built once per caption. Must not be modified in place."""
+    return build_token_class_table(tokenizer(caption), tokenizer, num_classes)
+
+
+def select_class_predictions(
+        prediction_logits: torch.Tensor,
+        prediction_boxes: torch.Tensor,
+        token_classes: torch.Tensor,
+        num_classes: int,
+        box_threshold: float,
+        text_threshold: float
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Class id of every box above box_threshold: the class of its highest scoring token
+    above text_threshold, or -1 when no token of any class is above text_threshold.
+    """
     mask = prediction_logits.max(dim=1)[0] > box_threshold
     logits = prediction_logits[mask]  # logits.shape = (n, 256)
     boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
 
-    tokenizer = model.tokenizer
-    tokenized = tokenizer(caption)
+    class_ids = get_class_ids_from_logits(logits, token_classes, num_classes, text_threshold)
+
+    return boxes, logits.max(dim=1)[0], class_ids
+
+
+def select_predictions(
+        prediction_logits: torch.Tensor,
+        prediction_boxes: torch.Tensor,
+        tokenized,
+        tokenizer,
+        box_threshold: float,
+        text_threshold: float
+) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
+    mask = prediction_logits.max(dim=1)[0] > box_threshold
+    logits = prediction_logits[mask]  # logits.shape = (n, 256)
+    boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
 
     phrases = [
         get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace('.', '')
@@ -114,12 +362,14 @@ class Model:
         self,
         model_config_path: str,
         model_checkpoint_path: str,
-        device: str = "cuda"
+        device: str = "cuda",
+        inference_mode: bool = True
     ):
         self.model = load_model(
             model_config_path=model_config_path,
             model_checkpoint_path=model_checkpoint_path,
-            device=device
+            device=device,
+            inference_mode=inference_mode
         ).to(device)
         self.device = device
 
@@ -148,7 +398,7 @@ class Model:
         box_annotator = sv.BoxAnnotator()
         annotated_image = box_annotator.annotate(scene=image, detections=detections, labels=labels)
         """
-        processed_image = Model.preprocess_image(image_bgr=image).to(self.device)
+        processed_image = preprocess_images([image], device=self.device)[0]
         boxes, logits, phrases = predict(
             model=self.model,
             image=processed_image,
@@ -164,6 +414,50 @@ class Model:
             logits=logits)
         return detections, phrases
 
+    def predict_with_captions(
+        self,
+        image: np.ndarray,
+        captions: List[str],
+        box_threshold: float = 0.35,
+        text_threshold: float = 0.25
+    ) -> List[Tuple[sv.Detections, List[str]]]:
+        """
+        Same as predict_with_caption for several independent captions, with a single
+        backbone pass. Returns one (detections, phrases) per caption.
+
+        import cv2
+
+        image = cv2.imread(IMAGE_PATH)
+
+        model = Model(model_config_path=CONFIG_PATH, model_checkpoint_path=WEIGHTS_PATH)
+        results = model.predict_with_captions(
+            image=image,
+            captions=["jacket", "shirt", "logo", "collar"],
+            box_threshold=BOX_THRESHOLD,
+            text_threshold=TEXT_THRESHOLD
+        )
+        for detections, labels in results:
+            ...
+        """
+        processed_image = preprocess_images([image], device=self.device)[0]
+        predictions = predict_captions(
+            model=self.model,
+            image=processed_image,
+            captions=captions,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            device=self.device)
+        source_h, source_w, _ = image.shape
+        results = []
+        for boxes, logits, phrases in predictions:
+            detections = Model.post_process_result(
+                source_h=source_h,
+                source_w=source_w,
+                boxes=boxes,
+                logits=logits)
+            results.append((detections, phrases))
+        return results
+
     def predict_with_classes(
         self,
         image: np.ndarray,
@@ -190,24 +484,57 @@ class Model:
         box_annotator = sv.BoxAnnotator()
         annotated_image = box_annotator.annotate(scene=image, detections=detections)
         """
-        caption = ". ".join(classes)
-        processed_image = Model.preprocess_image(image_bgr=image).to(self.device)
-        boxes, logits, phrases = predict(
+        return self.predict_batch(
+            images=[image],
+            classes=classes,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold)[0]
+
+    def predict_batch(
+        self,
+        images: List[np.ndarray],
+        classes: List[str],
+        box_threshold: float,
+        text_threshold: float
+    ) -> List[sv.Detections]:
+        """
+        Batched predict_with_classes: the images may have different sizes and go
+        through the model in a single forward pass with the caption replicated.
+        The class_id of a detection is -1 when none of its class tokens scores
+        above text_threshold.
+
+        import cv2
+
+        images = [cv2.imread(path) for path in IMAGE_PATHS]
+
+        model = Model(model_config_path=CONFIG_PATH, model_checkpoint_path=WEIGHTS_PATH)
+        detections_list = model.predict_batch(
+            images=images,
+            classes=CLASSES,
+            box_threshold=BOX_THRESHOLD,
+            text_threshold=TEXT_THRESHOLD
+        )
+        """
+        processed_images = preprocess_images(images, device=self.device)
+        predictions = predict_classes(
             model=self.model,
-            image=processed_image,
-            caption=caption,
+            images=processed_images,
+            classes=classes,
             box_threshold=box_threshold,
             text_threshold=text_threshold,
             device=self.device)
-        source_h, source_w, _ = image.shape
-        detections = Model.post_process_result(
-            source_h=source_h,
-            source_w=source_w,
-            boxes=boxes,
-            logits=logits)
-        class_id = Model.phrases2classes(phrases=phrases, classes=classes)
-        detections.class_id = class_id
-        return detections
+
+        detections_list = []
+        for image, (boxes, logits, class_ids) in zip(images, predictions):
+            source_h, source_w, _ = image.shape
+            detections = Model.post_process_result(
+                source_h=source_h,
+                source_w=source_w,
+                boxes=boxes,
+                logits=logits)
+            detections.class_id = class_ids.numpy()
+            detections_list.append(detections)
+        return detections_list
 
     @staticmethod
     def preprocess_image(image_bgr: np.ndarray) -> torch.Tensor:
@@ -236,22 +563,25 @@ class Model:
 
     @staticmethod
     def phrases2classes(phrases: List[str], classes: List[str]) -> np.ndarray:
+        # -1 for phrases that match no class, like the class_id of predict_with_classes
         class_ids = []
         for phrase in phrases:
             try:
                 # class_ids.append(classes.index(phrase))
                 class_ids.append(Model.find_index(phrase, classes))
             except ValueError:
-                class_ids.append(None)
-        return np.array(class_ids)
+                class_ids.append(-1)
+        return np.array(class_ids, dtype=int)
 
     @staticmethod
     def find_index(string, lst):
         # if meet string like "lake river" will only keep "lake"
         # this is an hack implementation for visualization which will be updated in the future
-        string = string.lower().split()[0]
+        words = string.lower().split()
+        if not words:
+            raise ValueError("empty phrase")
+        string = words[0]
         for i, s in enumerate(lst):
             if string in s.lower():
                 return i
-        print("There's a wrong phrase happen, this is because of our post-process merged wrong tokens, which will be modified in the future. We will assign it with a random label at this time.")
-        return 0
\ No newline at end of file
+        raise ValueError(f"phrase '{string}' does not match any class")
\ No newline at end of file
@@ -397,9 +397,13 @@ def _max_by_axis(the_list):
 
 
 class NestedTensor(object):
-    def __init__(self, tensors, mask: Optional[Tensor]):
+    def __init__(self, tensors, mask: Optional[Tensor], geometry: Optional[tuple] = None):
         self.tensors = tensors
         self.mask = mask
+        # host-side ((H, W), ((h, w), ...)): padded size of the input batch and unpadded size of
+        # every image, set by nested_tensor_from_tensor_list and kept by the per-level features,
+        # see GeometryCache.key
+        self.geometry = geometry
         if mask == "auto":
             self.mask = torch.zeros_like(tensors).to(tensors.device)
             if self.mask.dim() == 3:
@@ -431,7 +435,7 @@ class NestedTensor(object):
             cast_mask = mask.to(device)
         else:
             cast_mask = None
-        return NestedTensor(cast_tensor, cast_mask)
+        return NestedTensor(cast_tensor, cast_mask, self.geometry)
 
     def to_img_list_single(self, tensor, mask):
         assert tensor.dim() == 3, "dim of tensor should be 3 but {}".format(tensor.dim())
@@ -491,9 +495,10 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
         for img, pad_img, m in zip(tensor_list, tensor, mask):
             pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
             m[: img.shape[1], : img.shape[2]] = False
+        geometry = ((h, w), tuple((img.shape[1], img.shape[2]) for img in tensor_list))
     else:
         raise ValueError("not supported")
-    return NestedTensor(tensor, mask)
+    return NestedTensor(tensor, mask, geometry)
 
 
 # _onnx_nested_tensor_from_tensor_list() is an implementation of
@@ -606,3 +606,37 @@ def get_phrases_from_posmap(
         return tokenizer.decode(token_ids)
     else:
         raise NotImplementedError("posmap must be 1-dim")
+
+
+def build_token_class_table(tokenized: Dict, tokenizer: AutoTokenizer, num_classes: int):
+    """
+    Maps every token of a caption made of num_classes phrases separated by "." (or "?")
+    to the index of its phrase, and the special tokens to -1. Phrases beyond num_classes
+    are mapped to -1 as well.
+    """
+    input_ids = torch.as_tensor(tokenized["input_ids"])
+    special = torch.isin(input_ids, torch.as_tensor(tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]", ".", "?"])))
+    delimiter = torch.isin(input_ids, torch.as_tensor(tokenizer.convert_tokens_to_ids([".", "?"])))
+    # number of delimiters strictly before each token
+    phrase = delimiter.cumsum(0) - delimiter.long()
+    return phrase.masked_fill(special | (phrase >= num_classes), -1)
+
+
+def get_class_ids_from_logits(
+    logits: torch.Tensor, token_classes: torch.LongTensor, num_classes: int, text_threshold: float
+):
+    """
+    logits: n x max_text_len token scores of n boxes, token_classes: from build_token_class_table.
+    Returns the class of the highest scoring token above text_threshold for every box,
+    or -1 for the boxes without any class token above text_threshold.
+    """
+    n, text_len = logits.shape
+    token_classes = token_classes[:text_len].to(logits.device)
+    token_classes = torch.nn.functional.pad(token_classes, (0, text_len - len(token_classes)), value=-1)
+    # special tokens and padding go to an extra column that is dropped afterwards
+    index = token_classes.masked_fill(token_classes < 0, num_classes).expand(n, -1)
+    scores = logits.masked_fill(logits <= text_threshold, -1.0)
+    class_scores = logits.new_full((n, num_classes + 1), -1.0)
+    class_scores = class_scores.scatter_reduce(1, index, scores, "amax")[:, :num_classes]
+    best, class_ids = class_scores.max(dim=1)
+    return class_ids.masked_fill(best < 0, -1)
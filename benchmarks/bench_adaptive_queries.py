@@ -0,0 +1,110 @@
+"""
+Recall versus latency of adaptive query selection in GroundingDINO.
+
+The baseline decodes the fixed top 900 encoder proposals. Each setting of
+GroundingDINO.set_adaptive_queries decodes fewer of them and may prune more
+between decoder layers. For every setting this script reports the mean
+forward latency and the recall of the baseline detections (boxes above
+--box_threshold) at IoU >= --iou, over a folder of images.
+
+    python benchmarks/bench_adaptive_queries.py --images instance_folder --caption "jacket . shirt ."
+"""
+import argparse
+import os
+import time
+import warnings
+
+import torch
+from torchvision.ops import box_convert, box_iou
+
+from groundingdino.util.inference import load_image, load_model, preprocess_caption
+
+warnings.filterwarnings("ignore")
+
+# (min_queries, max_queries, score_threshold, prune_threshold)
+SETTINGS = [
+    (100, 900, 0.05, None),
+    (50, 300, 0.05, None),
+    (50, 300, 0.10, None),
+    (20, 100, 0.10, None),
+    (50, 300, 0.05, 0.05),
+    (20, 100, 0.10, 0.10),
+]
+
+
+def detect(model, image, caption, box_threshold, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        outputs = model(image[None], captions=[caption])
+    logits = outputs["pred_logits"][0].sigmoid().max(-1)[0]
+    boxes = outputs["pred_boxes"][0][logits > box_threshold].cpu()
+    elapsed = time.perf_counter() - start
+    return box_convert(boxes, in_fmt="cxcywh", out_fmt="xyxy"), elapsed
+
+
+def matched(reference, boxes, iou_threshold):
+    if len(reference) == 0 or len(boxes) == 0:
+        return 0
+    return int((box_iou(reference, boxes).max(1)[0] >= iou_threshold).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser("Adaptive query selection: recall versus latency")
+    parser.add_argument("--config", default="GroundingDINO/groundingdino/config/GroundingDINO_SwinB.py")
+    parser.add_argument("--checkpoint", default="./groundingdino_swinb_cogcoor.pth")
+    parser.add_argument("--images", required=True, help="folder of images")
+    parser.add_argument("--caption", default="jacket . shirt .")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--box_threshold", type=float, default=0.25)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--max_images", type=int, default=50)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    model = load_model(opt.config, opt.checkpoint, device=opt.device).to(device)
+    caption = preprocess_caption(opt.caption)
+
+    paths = sorted(
+        os.path.join(opt.images, name)
+        for name in os.listdir(opt.images)
+        if name.lower().endswith((".jpg", ".jpeg", ".png"))
+    )[: opt.max_images]
+    images = [load_image(path)[1].to(device) for path in paths]
+
+    # warm up, also fills the caption cache
+    detect(model, images[0], caption, opt.box_threshold, device)
+
+    model.set_adaptive_queries(None)
+    baseline, baseline_time = [], 0.0
+    for image in images:
+        boxes, elapsed = detect(model, image, caption, opt.box_threshold, device)
+        baseline.append(boxes)
+        baseline_time += elapsed
+    n_reference = sum(len(boxes) for boxes in baseline)
+    print(
+        f"device={device} images={len(images)} reference boxes={n_reference} "
+        f"baseline (900 queries) {baseline_time / len(images) * 1000:.1f} ms/image"
+    )
+
+    for min_queries, max_queries, score_threshold, prune_threshold in SETTINGS:
+        model.set_adaptive_queries(min_queries, max_queries, score_threshold, prune_threshold)
+        hits, extra, total_time = 0, 0, 0.0
+        for image, reference in zip(images, baseline):
+            boxes, elapsed = detect(model, image, caption, opt.box_threshold, device)
+            total_time += elapsed
+            hits += matched(reference, boxes, opt.iou)
+            extra += max(len(boxes) - len(reference), 0)
+        recall = hits / n_reference if n_reference > 0 else 1.0
+        latency = total_time / len(images)
+        print(
+            f"[min={min_queries} max={max_queries} score>{score_threshold} prune={prune_threshold}] "
+            f"{latency * 1000:.1f} ms/image ({baseline_time / len(images) / latency:.2f}x) "
+            f"recall={recall:.3f} extra boxes={extra}"
+        )
+    model.set_adaptive_queries(None)
+
+
+if __name__ == "__main__":
+    main()
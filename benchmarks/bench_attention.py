@@ -0,0 +1,77 @@
+"""
+Agreement, latency and peak memory of the ViT encoder attention implementations.
+
+Runs one global-attention layer of the RobustSAM image encoder (ViT-L: 1024
+channels, 16 heads, 64x64 tokens, relative position embeddings) with the
+"math" implementation and with "sdpa" at every --tiles query tile size
+(0 for no tiling). It checks that every "sdpa" variant agrees with "math"
+within --atol and reports the latency and the peak memory of a forward pass,
+read from the CUDA allocator or, on Linux CPUs, from the peak RSS of a fresh
+process per measurement.
+
+    python benchmarks/bench_attention.py --device cuda --tiles 0 1024 256
+"""
+import argparse
+from functools import partial
+
+import torch
+
+from harness import latency_ms, peak_memory_mb
+from robust_segment_anything.modeling.image_encoder import Attention
+
+
+def build(opt, impl, tile, device):
+    torch.manual_seed(0)
+    size = (opt.size, opt.size)
+    attn = Attention(opt.dim, opt.heads, use_rel_pos=True, input_size=size, impl=impl, query_tile=tile or None)
+    with torch.no_grad():
+        attn.rel_pos_h.normal_(0, 0.5)
+        attn.rel_pos_w.normal_(0, 0.5)
+    x = torch.randn(opt.batch, opt.size, opt.size, opt.dim)
+    return attn.eval().to(device), x.to(device)
+
+
+def forward(attn, x):
+    return attn(x)
+
+
+def main():
+    parser = argparse.ArgumentParser("Encoder attention: agreement, latency and peak memory")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--size", type=int, default=64, help="tokens per side")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--tiles", type=int, nargs="+", default=[0, 1024, 256])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    attn, x = build(opt, "math", None, device)
+    with torch.no_grad():
+        reference = attn(x)
+    math_ms = latency_ms(partial(attn, x), device, opt.repeats)
+    del attn
+    math_mb = peak_memory_mb(partial(build, opt, "math", None), forward, device)
+    print(
+        f"device={device} batch={opt.batch} tokens={opt.size}x{opt.size} dim={opt.dim} heads={opt.heads}\n"
+        f"[math] {math_ms:.1f} ms {math_mb:.0f} MB"
+    )
+
+    for tile in opt.tiles:
+        attn, x = build(opt, "sdpa", tile, device)
+        with torch.no_grad():
+            error = float((attn(x) - reference).abs().max())
+        assert error <= opt.atol, f"sdpa, tile {tile}: max error {error:.2e} > {opt.atol:.0e}"
+        sdpa_ms = latency_ms(partial(attn, x), device, opt.repeats)
+        del attn
+        sdpa_mb = peak_memory_mb(partial(build, opt, "sdpa", tile), forward, device)
+        print(
+            f"[sdpa, tile {tile or 'none'}] {sdpa_ms:.1f} ms {sdpa_mb:.0f} MB "
+            f"max error {error:.1e} ({math_ms / sdpa_ms:.2f}x, {math_mb / max(sdpa_mb, 1e-6):.2f}x less memory)"
+        )
+
+
+if __name__ == "__main__":
+    main()
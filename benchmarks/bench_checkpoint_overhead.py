@@ -0,0 +1,118 @@
+"""
+Measures what activation checkpointing costs at inference in GroundingDINO.
+
+The SwinB config builds the Swin backbone and the encoder with checkpointing
+enabled. Under torch.no_grad() every checkpointed call still goes through an
+autograd Function and stashes the RNG state, without saving any memory. This
+script times the backbone and the encoder with and without the checkpoint
+wrappers (see GroundingDINO.set_inference_mode) on random weights and reports
+the overhead per wrapped layer.
+
+    python benchmarks/bench_checkpoint_overhead.py --device cuda
+"""
+import argparse
+import time
+import warnings
+
+import torch
+
+from groundingdino.models.GroundingDINO.backbone.swin_transformer import build_swin_transformer
+from groundingdino.models.GroundingDINO.transformer import build_transformer
+from groundingdino.util.slconfig import SLConfig
+
+warnings.filterwarnings("ignore")
+
+
+def set_checkpointing(module, enabled):
+    for m in module.modules():
+        if hasattr(m, "use_checkpoint"):
+            m.use_checkpoint = enabled
+        if hasattr(m, "use_transformer_ckpt"):
+            m.use_transformer_ckpt = enabled
+
+
+def timeit(fn, device, iters, warmup=2):
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def encoder_inputs(args, device, height, width, n_text):
+    bs, d_model = 1, args.hidden_dim
+    # strides 8, 16, 32 and 64 as produced by the backbone and the extra input projection
+    spatial_shapes = torch.tensor(
+        [[-(-height // s), -(-width // s)] for s in (8, 16, 32, 64)], device=device
+    )
+    sizes = spatial_shapes.prod(1)
+    level_start_index = torch.cat((sizes.new_zeros(1), sizes.cumsum(0)[:-1]))
+    n_img = int(sizes.sum())
+    return dict(
+        src=torch.randn(bs, n_img, d_model, device=device),
+        pos=torch.randn(bs, n_img, d_model, device=device),
+        spatial_shapes=spatial_shapes,
+        level_start_index=level_start_index,
+        valid_ratios=torch.ones(bs, 4, 2, device=device),
+        key_padding_mask=torch.zeros(bs, n_img, dtype=torch.bool, device=device),
+        memory_text=torch.randn(bs, n_text, d_model, device=device),
+        text_attention_mask=torch.zeros(bs, n_text, dtype=torch.bool, device=device),
+        position_ids=torch.arange(n_text, device=device)[None],
+        text_self_attention_masks=torch.ones(bs, n_text, n_text, dtype=torch.bool, device=device),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("Activation checkpointing overhead at inference")
+    parser.add_argument("--config", default="GroundingDINO/groundingdino/config/GroundingDINO_SwinB.py")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--n_text", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=5)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    args = SLConfig.fromfile(opt.config)
+
+    backbone = build_swin_transformer(
+        args.backbone,
+        pretrain_img_size=int(args.backbone.split("_")[-2]),
+        out_indices=tuple(args.return_interm_indices),
+        dilation=False,
+        use_checkpoint=True,
+    ).to(device)
+    backbone.eval()
+    encoder = build_transformer(args).encoder.to(device).eval()
+
+    image = torch.randn(1, 3, opt.height, opt.width, device=device)
+    inputs = encoder_inputs(args, device, opt.height, opt.width, opt.n_text)
+
+    n_swin_blocks = sum(len(layer.blocks) for layer in backbone.layers)
+    n_encoder_layers = len(encoder.layers) + len(encoder.fusion_layers)
+
+    print(f"device={device} image={opt.height}x{opt.width} iters={opt.iters}")
+    for name, module, run, n_wrapped in (
+        ("swin backbone", backbone, lambda: backbone.forward_raw(image), n_swin_blocks),
+        ("encoder", encoder, lambda: encoder(**inputs), n_encoder_layers),
+    ):
+        timings = {}
+        with torch.no_grad():
+            for enabled in (True, False):
+                set_checkpointing(module, enabled)
+                timings[enabled] = timeit(run, device, opt.iters)
+        overhead = timings[True] - timings[False]
+        print(
+            f"[{name}] checkpointed {timings[True] * 1000:.1f} ms, direct {timings[False] * 1000:.1f} ms, "
+            f"overhead {overhead * 1000:.2f} ms total / {overhead * 1000 / n_wrapped:.3f} ms "
+            f"per layer over {n_wrapped} wrapped layers"
+        )
+
+
+if __name__ == "__main__":
+    main()
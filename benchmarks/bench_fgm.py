@@ -0,0 +1,101 @@
+"""
+Agreement, latency and peak memory of the real-FFT FGMBlock.
+
+FGMBlock runs on the half spectrum of rfft2 and rescales it by the magnitude
+ratio. This script compares it with the original complex path (fft2, angle,
+cos/sin, ifft2) on the three AMFG blocks of the RobustSAM mask decoder at
+their ViT-L shapes, with clear=False so that FGM runs:
+
+    FirstLayerFeatureBlock  2 x 1024 channels at 64x64
+    LastLayerFeatureBlock   2 x 256 channels at 64x64
+    MaskFeatureBlock        2 x 32 channels at 256x256
+
+For every block it checks that both paths agree within --atol (relative to
+the output scale) and reports the latency and the peak memory of a forward
+pass. Peak memory is read from the CUDA allocator, or on Linux CPUs from the
+peak RSS of a fresh process per measurement.
+
+    python benchmarks/bench_fgm.py --device cuda
+"""
+import argparse
+from functools import partial
+
+import torch
+
+from harness import latency_ms, peak_memory_mb
+from robust_segment_anything.modeling.components import (
+    FGMBlock,
+    FirstLayerFeatureBlock,
+    LastLayerFeatureBlock,
+    MaskFeatureBlock,
+)
+
+# (name, constructor, input channels, input size) at ViT-L / transformer_dim=256
+BLOCKS = [
+    ("first layer", lambda: FirstLayerFeatureBlock(vit_dim=1024, transformer_dim=256), 1024, 64),
+    ("last layer", lambda: LastLayerFeatureBlock(transformer_dim=256), 256, 64),
+    ("mask", lambda: MaskFeatureBlock(transformer_dim=256), 32, 256),
+]
+
+
+def fgm_complex(self, x):
+    """The original FGMBlock.forward, on the full complex spectrum."""
+    fft_map = torch.fft.fft2(x, dim=(-2, -1))
+    magnitude_map = torch.abs(fft_map)
+    phase_map = torch.angle(fft_map)
+    modified_magnitude = self.conv_layer(magnitude_map)
+    real_part = modified_magnitude * torch.cos(phase_map)
+    imag_part = modified_magnitude * torch.sin(phase_map)
+    modified_fft_map = torch.complex(real_part, imag_part)
+    return torch.real(torch.fft.ifft2(modified_fft_map, dim=(-2, -1)))
+
+
+def build(index, device):
+    torch.manual_seed(0)
+    name, make, channels, size = BLOCKS[index]
+    block = make().eval().to(device)
+    x = torch.randn(1, channels, size, size, device=device)
+    return block, x
+
+
+def run(block, x, legacy):
+    forward = FGMBlock.forward
+    if legacy:
+        FGMBlock.forward = fgm_complex
+    try:
+        with torch.no_grad():
+            return block(x, clear=False)
+    finally:
+        FGMBlock.forward = forward
+
+
+def main():
+    parser = argparse.ArgumentParser("Real-FFT FGMBlock: agreement, latency and peak memory")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    print(f"device={device}")
+    for index, (name, _, channels, size) in enumerate(BLOCKS):
+        block, x = build(index, device)
+        reference = run(block, x, legacy=True)
+        output = run(block, x, legacy=False)
+        error = float((output - reference).abs().max() / reference.abs().max())
+        assert error <= opt.atol, f"{name}: relative error {error:.2e} > {opt.atol:.0e}"
+
+        legacy_ms = latency_ms(partial(run, block, x, True), device, opt.repeats)
+        rfft_ms = latency_ms(partial(run, block, x, False), device, opt.repeats)
+        del block, x, reference, output
+        legacy_mb = peak_memory_mb(partial(build, index), partial(run, legacy=True), device)
+        rfft_mb = peak_memory_mb(partial(build, index), partial(run, legacy=False), device)
+        print(
+            f"[{name}: {2 * channels} x {size}x{size}] relative error {error:.1e} | "
+            f"fft2 {legacy_ms:.1f} ms {legacy_mb:.0f} MB | rfft2 {rfft_ms:.1f} ms {rfft_mb:.0f} MB "
+            f"({legacy_ms / rfft_ms:.2f}x, {legacy_mb / max(rfft_mb, 1e-6):.2f}x less memory)"
+        )
+
+
+if __name__ == "__main__":
+    main()
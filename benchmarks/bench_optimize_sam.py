@@ -0,0 +1,98 @@
+"""
+Agreement and latency of optimize_for_inference on RobustSAM.
+
+Builds the model (random weights unless --checkpoint is given), encodes one
+random image, then decodes --boxes random box prompts with the original and
+the optimized model through Sam.predict (clear=False), and with --clear
+through the SamPredictor path (clear=True). The image encoder is shared, so
+the reported latency is the one of the prompt encoder and the mask decoder.
+
+    python benchmarks/bench_optimize_sam.py --model_size l --checkpoint robustsam_checkpoint_l.pth
+"""
+import argparse
+import time
+
+import torch
+
+from robust_segment_anything import sam_model_registry
+from robust_segment_anything.utils.optimize import optimize_for_inference
+
+
+def decode(model, record, clear, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        if clear:
+            sparse, dense = model.prompt_encoder(points=None, boxes=record["boxes"], masks=None)
+            logits, _, _, _ = model.mask_decoder(
+                image_embeddings=record["image_embeddings"][None],
+                image_pe=model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse,
+                dense_prompt_embeddings=dense,
+                multimask_output=False,
+                encoder_features=record["encoder_features"][None, None],
+                clear=True,
+            )
+        else:
+            logits = model.predict(None, [record], multimask_output=False)[0]["low_res_logits"]
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return logits, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser("optimize_for_inference: agreement and latency")
+    parser.add_argument("--model_size", default="l", choices=["b", "l", "h"])
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--boxes", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--clear", action="store_true", help="decode with clear=True")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+    sam = sam_model_registry["vit_{}".format(opt.model_size)](opt=opt, checkpoint=opt.checkpoint).to(device).eval()
+    if opt.checkpoint is None:
+        # give the folded BatchNorms non-trivial statistics
+        for module in sam.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+    optimized = optimize_for_inference(sam, clear=opt.clear)
+
+    size = sam.image_encoder.img_size
+    image = torch.rand(3, size, size, device=device) * 255
+    corners = torch.rand(opt.boxes, 2, 2, device=device).sort(dim=1)[0] * size
+    with torch.no_grad():
+        image_embeddings, encoder_features = sam.image_encoder(sam.preprocess(image[None]))
+    record = {
+        "image": image,
+        "boxes": corners.flatten(1),
+        "original_size": (size, size),
+        "image_embeddings": image_embeddings[0],
+        "encoder_features": encoder_features[0][0],
+    }
+
+    reference, _ = decode(sam, record, opt.clear, device)
+    output, _ = decode(optimized, record, opt.clear, device)
+    error = float((output - reference).abs().max())
+    assert error <= opt.atol, f"max error {error:.2e} > {opt.atol:.0e}"
+
+    original_time = sum(decode(sam, record, opt.clear, device)[1] for _ in range(opt.repeats)) / opt.repeats
+    optimized_time = sum(decode(optimized, record, opt.clear, device)[1] for _ in range(opt.repeats)) / opt.repeats
+    removed = sum(p.numel() for p in sam.parameters()) - sum(p.numel() for p in optimized.parameters())
+    print(
+        f"device={device} vit_{opt.model_size} clear={opt.clear} boxes={opt.boxes} "
+        f"max logit error={error:.1e} parameters removed={removed}"
+    )
+    print(
+        f"original {original_time * 1000:.1f} ms, optimized {optimized_time * 1000:.1f} ms, "
+        f"delta {(optimized_time - original_time) * 1000:+.1f} ms ({original_time / optimized_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Latency and agreement of the tensor-native GroundingDINO preprocessing.
+
+Runs Model.preprocess_image (cv2 -> PIL -> RandomResize/ToTensor/Normalize)
+and preprocess_images over the same BGR images, checks that every output has
+the same shape and stays within PREPROCESS_TOLERANCE of the PIL path, and
+reports the mean latency per image of both. Without --images it uses random
+images of a few common sizes.
+
+    python benchmarks/bench_preprocess.py --images instance_folder --device cuda
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from groundingdino.util.inference import PREPROCESS_TOLERANCE, Model, preprocess_images
+
+SIZES = [(480, 640), (720, 1280), (1080, 1920), (1200, 800), (300, 200)]
+
+
+def timed(fn, device, repeats):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser("Tensor-native preprocessing: agreement and latency")
+    parser.add_argument("--images", default=None, help="folder of images, random images if not set")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max_images", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=5)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    if opt.images is None:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in SIZES]
+    else:
+        paths = sorted(
+            os.path.join(opt.images, name)
+            for name in os.listdir(opt.images)
+            if name.lower().endswith((".jpg", ".jpeg", ".png"))
+        )[: opt.max_images]
+        images = [cv2.imread(path) for path in paths]
+
+    reference = [Model.preprocess_image(image_bgr=image) for image in images]
+    fast = preprocess_images(images, device=opt.device)
+    max_error = 0.0
+    for image, ref, out in zip(images, reference, fast):
+        assert ref.shape == out.shape, f"{image.shape}: {tuple(ref.shape)} != {tuple(out.shape)}"
+        max_error = max(max_error, float((ref - out.cpu()).abs().max()))
+    assert max_error <= PREPROCESS_TOLERANCE, f"max error {max_error:.4f} > {PREPROCESS_TOLERANCE:.4f}"
+
+    pil_time = timed(lambda: [Model.preprocess_image(image_bgr=image).to(device) for image in images], device, opt.repeats)
+    fast_time = timed(lambda: preprocess_images(images, device=opt.device), device, opt.repeats)
+    print(f"device={device} images={len(images)} max error={max_error:.4f} (tolerance {PREPROCESS_TOLERANCE:.4f})")
+    print(
+        f"PIL {pil_time / len(images) * 1000:.2f} ms/image, "
+        f"tensor {fast_time / len(images) * 1000:.2f} ms/image ({pil_time / fast_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
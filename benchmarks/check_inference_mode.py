@@ -0,0 +1,87 @@
+"""
+Agreement of the GroundingDINO inference-mode build with the checkpointed one.
+
+Builds the model twice from the same config and weights (random weights
+unless --checkpoint is given): once with activation checkpointing in the
+Swin backbone and the encoder, as the training configs do, and once with
+args.inference_mode, which calls the layers directly, only runs the heads of
+the last decoder layer and caches the mask-only tensors. It runs both on the
+same random image and caption and checks that the logits and the boxes
+agree within --atol.
+
+    python benchmarks/check_inference_mode.py --checkpoint groundingdino_swinb_cogcoor.pth
+"""
+import argparse
+import warnings
+
+import torch
+
+from groundingdino.models import build_model
+from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.slconfig import SLConfig
+
+warnings.filterwarnings("ignore")
+
+
+def build(opt, inference_mode):
+    args = SLConfig.fromfile(opt.config)
+    args.device = opt.device
+    if opt.bert_base_uncased_path is not None:
+        args.bert_base_uncased_path = opt.bert_base_uncased_path
+    if inference_mode:
+        args.inference_mode = True
+    else:
+        args.use_checkpoint = True
+        args.use_transformer_ckpt = True
+    torch.manual_seed(0)
+    return build_model(args)
+
+
+def main():
+    parser = argparse.ArgumentParser("Inference mode against activation checkpointing: agreement")
+    parser.add_argument("--config", default="GroundingDINO/groundingdino/config/GroundingDINO_SwinB.py")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--bert_base_uncased_path", default=None)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--caption", default="jacket . shirt .")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    checkpointed = build(opt, inference_mode=False)
+    if opt.checkpoint is not None:
+        state_dict = clean_state_dict(torch.load(opt.checkpoint, map_location="cpu")["model"])
+        checkpointed.load_state_dict(state_dict, strict=False)
+    else:
+        # the box heads start at zero, give them weights so that the boxes depend on the decoder
+        for name, p in checkpointed.named_parameters():
+            if "bbox_embed" in name and not p.any():
+                torch.nn.init.normal_(p, std=0.01)
+    inference = build(opt, inference_mode=True)
+    inference.load_state_dict(checkpointed.state_dict())
+    checkpointed.to(device).eval()
+    inference.to(device).eval()
+
+    torch.manual_seed(1)
+    image = torch.randn(1, 3, opt.height, opt.width, device=device)
+    with torch.no_grad():
+        reference = checkpointed(image, captions=[opt.caption])
+        output = inference(image, captions=[opt.caption])
+
+    # the logits are -inf past the caption tokens
+    logits_error = float(
+        (output["pred_logits"].nan_to_num() - reference["pred_logits"].nan_to_num()).abs().max()
+    )
+    boxes_error = float((output["pred_boxes"] - reference["pred_boxes"]).abs().max())
+    assert logits_error <= opt.atol, f"logits: max error {logits_error:.2e} > {opt.atol:.0e}"
+    assert boxes_error <= opt.atol, f"boxes: max error {boxes_error:.2e} > {opt.atol:.0e}"
+    print(
+        f"device={device} image={opt.height}x{opt.width} caption={opt.caption!r} "
+        f"max logit error={logits_error:.1e} max box error={boxes_error:.1e}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Agreement of the CPU multi-scale deformable attention kernel with the PyTorch fallback.
+
+Runs ms_deform_attn_cpu_forward (through groundingdino._C) and
+multi_scale_deformable_attn_pytorch on the same random inputs, with the four
+feature levels of an 800x1066 image, a batch of --batch, and sampling
+locations drawn from [-0.25, 1.25] so that some points fall outside the
+feature maps and exercise the zero padding. It checks float32 and float64
+against their own tolerance. The C++ extension must be built first:
+
+    python setup.py build_ext --inplace  # from GroundingDINO/
+    python benchmarks/check_ms_deform_attn_cpu.py --batch 2
+"""
+import argparse
+
+import torch
+
+from groundingdino.models.GroundingDINO.ms_deform_attn import _C, multi_scale_deformable_attn_pytorch
+
+# strides 8, 16, 32 and 64 of an 800x1066 input
+SPATIAL_SHAPES = [(100, 134), (50, 67), (25, 34), (13, 17)]
+TOLERANCES = {torch.float32: 1e-4, torch.float64: 1e-10}
+
+
+def inputs(opt, dtype):
+    torch.manual_seed(0)
+    spatial_shapes = torch.tensor(SPATIAL_SHAPES)
+    sizes = spatial_shapes.prod(1)
+    level_start_index = torch.cat((sizes.new_zeros(1), sizes.cumsum(0)[:-1]))
+    num_levels = len(SPATIAL_SHAPES)
+    value = torch.randn(opt.batch, int(sizes.sum()), opt.heads, opt.channels, dtype=dtype)
+    sampling_locations = (
+        torch.rand(opt.batch, opt.queries, opt.heads, num_levels, opt.points, 2, dtype=dtype) * 1.5 - 0.25
+    )
+    attention_weights = torch.rand(opt.batch, opt.queries, opt.heads, num_levels, opt.points, dtype=dtype)
+    attention_weights = attention_weights.flatten(-2).softmax(-1).view_as(attention_weights)
+    return value, spatial_shapes, level_start_index, sampling_locations, attention_weights
+
+
+def main():
+    parser = argparse.ArgumentParser("CPU multi-scale deformable attention: agreement")
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=900)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--points", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--im2col_step", type=int, default=64)
+    opt = parser.parse_args()
+
+    assert _C is not None, "groundingdino._C is not built, see the usage above"
+    for dtype, atol in TOLERANCES.items():
+        value, spatial_shapes, level_start_index, sampling_locations, attention_weights = inputs(opt, dtype)
+        outside = ((sampling_locations < 0) | (sampling_locations > 1)).any(-1).float().mean()
+        with torch.no_grad():
+            reference = multi_scale_deformable_attn_pytorch(
+                value, spatial_shapes, sampling_locations, attention_weights
+            )
+            output = _C.ms_deform_attn_forward(
+                value, spatial_shapes, level_start_index, sampling_locations, attention_weights, opt.im2col_step
+            )
+        assert output.shape == reference.shape, f"{dtype}: {tuple(output.shape)} != {tuple(reference.shape)}"
+        error = float((output - reference).abs().max())
+        assert error <= atol, f"{dtype}: max error {error:.2e} > {atol:.0e}"
+        print(
+            f"{dtype} batch={opt.batch} queries={opt.queries} heads={opt.heads} points={opt.points} "
+            f"outside [0, 1]={outside:.0%} max error={error:.1e} (tolerance {atol:.0e})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Agreement of the vectorised special-token text masks with the original loop.
+
+generate_masks_with_special_tokens_and_transfer_map builds the text
+self-attention mask, the position ids and the category-to-token masks from
+segment ids instead of walking the special tokens ("[CLS]", "[SEP]", ".",
+"?") one by one. This script runs both versions on captions with repeated,
+adjacent, leading and trailing special tokens, one caption at a time and as a
+padded batch, and checks that all three outputs are identical. The loop
+raises in torch.stack when a caption has no category; the vectorised version
+must then return an empty category mask.
+
+    python benchmarks/check_special_token_masks.py --text_encoder bert-base-uncased
+"""
+import argparse
+import warnings
+
+import torch
+from transformers import AutoTokenizer
+
+from groundingdino.models.GroundingDINO.bertwarper import generate_masks_with_special_tokens_and_transfer_map
+
+warnings.filterwarnings("ignore")
+
+CAPTIONS = [
+    "jacket . shirt .",
+    "cat . . dog .",  # repeated
+    "cat . ? dog ?",  # adjacent
+    ". ? cat .",  # leading
+    "cat . dog . . ?",  # trailing
+    "cat . dog",  # last category not closed by a separator
+    "a red jacket",  # no separator
+    ". . .",  # separators only
+]
+
+
+def generate_masks_loop(tokenized, special_tokens_list, tokenizer):
+    """The original generate_masks_with_special_tokens_and_transfer_map, up to the final
+    torch.stack of the category masks, which is left to the caller."""
+    input_ids = tokenized["input_ids"]
+    bs, num_token = input_ids.shape
+    # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
+    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    for special_token in special_tokens_list:
+        special_tokens_mask |= input_ids == special_token
+
+    # idxs: each row is a list of indices of special tokens
+    idxs = torch.nonzero(special_tokens_mask)
+
+    # generate attention mask and positional ids
+    attention_mask = (
+        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    )
+    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
+    cate_to_token_mask_list = [[] for _ in range(bs)]
+    previous_col = 0
+    for i in range(idxs.shape[0]):
+        row, col = idxs[i]
+        if (col == 0) or (col == num_token - 1):
+            attention_mask[row, col, col] = True
+            position_ids[row, col] = 0
+        else:
+            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
+            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
+                0, col - previous_col, device=input_ids.device
+            )
+            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
+            c2t_maski[previous_col + 1 : col] = True
+            cate_to_token_mask_list[row].append(c2t_maski)
+        previous_col = col
+
+    return attention_mask, position_ids.to(torch.long), cate_to_token_mask_list
+
+
+def check(captions, tokenizer, special_tokens):
+    """Compares both versions on a batch of captions, returns the number of categories."""
+    tokenized = tokenizer(captions, padding="longest", return_tensors="pt")
+    attention_mask, position_ids, cate_to_token = generate_masks_with_special_tokens_and_transfer_map(
+        tokenized, special_tokens, tokenizer
+    )
+    ref_attention_mask, ref_position_ids, ref_cate_to_token = generate_masks_loop(
+        tokenized, special_tokens, tokenizer
+    )
+
+    assert torch.equal(attention_mask, ref_attention_mask), f"{captions}: attention masks differ"
+    assert torch.equal(position_ids, ref_position_ids), f"{captions}: position ids differ"
+    assert len(cate_to_token) == len(ref_cate_to_token), f"{captions}: batch sizes differ"
+    for caption, out, ref in zip(captions, cate_to_token, ref_cate_to_token):
+        if not ref:
+            # the original raised in torch.stack here
+            assert out.shape == (0, tokenized["input_ids"].shape[1]), f"{caption!r}: expected no category"
+            continue
+        assert torch.equal(out, torch.stack(ref, dim=0)), f"{caption!r}: category masks differ"
+    return sum(len(ref) for ref in ref_cate_to_token)
+
+
+def main():
+    parser = argparse.ArgumentParser("Vectorised special-token text masks: agreement")
+    parser.add_argument("--text_encoder", default="bert-base-uncased", help="tokenizer name or path")
+    opt = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(opt.text_encoder)
+    special_tokens = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]", ".", "?"])
+
+    for caption in CAPTIONS:
+        num_categories = check([caption], tokenizer, special_tokens)
+        print(f"{caption!r}: {num_categories} categories, identical")
+    num_categories = check(CAPTIONS, tokenizer, special_tokens)
+    print(f"padded batch of {len(CAPTIONS)} captions: {num_categories} categories, identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Latency and peak memory measurements shared by the benchmark scripts.
+
+Peak memory is read from the CUDA allocator, or on Linux CPUs from the peak
+RSS of a fresh process per measurement, so that the measurements do not see
+each other's allocations.
+"""
+import multiprocessing
+import os
+import time
+
+import torch
+
+
+def rss_kb(field):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+
+def cpu_peak(build, run, result):
+    # runs in a fresh process: peak RSS during run above the RSS after build
+    state = build("cpu")
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # resets VmHWM, the peak RSS
+    before = rss_kb("VmRSS:")
+    with torch.no_grad():
+        run(*state)
+    result.put(rss_kb("VmHWM:") - before)
+
+
+def peak_memory_mb(build, run, device):
+    """
+    Peak memory in MB of run(*build(device)) under torch.no_grad(), above the
+    memory held after build. On CPUs, build and run are sent to a spawned
+    process, so they must be picklable: module-level functions or partials.
+    """
+    if device.type == "cuda":
+        state = build(device)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        with torch.no_grad():
+            run(*state)
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    # large buffers are mmapped and unmapped on free, so that RSS follows the live tensors
+    os.environ["MALLOC_MMAP_THRESHOLD_"] = "65536"
+    context = multiprocessing.get_context("spawn")
+    result = context.Queue()
+    process = context.Process(target=cpu_peak, args=(build, run, result))
+    process.start()
+    peak_kb = result.get()
+    process.join()
+    return peak_kb / 1024
+
+
+def latency_ms(fn, device, repeats):
+    """Mean latency in ms of fn() under torch.no_grad(), after one warm-up call."""
+    with torch.no_grad():
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000
@@ -0,0 +1,131 @@
+import itertools
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+# Sentinel pushed into the render queue to stop the writer thread
+_STOP = object()
+
+
+class DebugSink:
+    """
+    Writes debug images for a sample of the processed images, off the hot path.
+
+    The sink is disabled until `configure` is called with an output directory
+    and a sampling period. Then 1 in `every` images is sampled: `sampled`
+    makes the decision once per ImageHandle and stores it on the handle, so
+    every stage that reads it agrees, and the stages hand the raw arrays of
+    a sampled image to `submit`. A single background thread renders them with
+    cv2 and writes them under a name that is unique per image, so concurrent
+    workers never overwrite each other's files. When the render queue is full
+    the artifact is dropped instead of blocking inference.
+
+    Usage:
+        debug_sink.configure("./debug", every=100)
+        if debug_sink.sampled(image):
+            debug_sink.submit("after_grounded", image.path, render_detections, image.bgr, boxes, labels)
+    """
+
+    def __init__(self, out_dir=None, every=0, queue_size=16):
+        self.out_dir = None
+        self.every = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._counter = itertools.count()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.configure(out_dir, every)
+
+    @property
+    def enabled(self):
+        return self.out_dir is not None and self.every > 0
+
+    def configure(self, out_dir, every):
+        """Enables the sink for 1 in `every` images, or disables it when out_dir is None or every <= 0."""
+        self.out_dir = out_dir
+        self.every = every
+        if not self.enabled:
+            return
+        os.makedirs(out_dir, exist_ok=True)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="debug-sink", daemon=True)
+                self._thread.start()
+
+    def sample(self):
+        """Returns True for 1 in `every` calls while the sink is enabled."""
+        if not self.enabled:
+            return False
+        return next(self._counter) % self.every == 0
+
+    def sampled(self, image):
+        """
+        Returns whether the debug images of an ImageHandle are written. The
+        first call for a handle draws from `sample`, later ones return the
+        decision stored on the handle.
+        """
+        if image.debug is None:
+            image.debug = self.sample()
+        return image.debug
+
+    def submit(self, name, source, render, *args):
+        """
+        Queues `render(*args)` to be run on the background thread. `render`
+        returns a BGR image that is written as <source stem>_<id>_<name>.png.
+        The arrays in `args` must not be modified by the caller afterwards.
+        """
+        if not self.enabled:
+            return
+        stem = os.path.splitext(os.path.basename(source))[0] if source else "image"
+        path = os.path.join(self.out_dir, f"{stem}_{next(self._ids)}_{name}.png")
+        try:
+            self._queue.put_nowait((path, render, args))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self):
+        """Writes the queued artifacts and stops the background thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            path, render, args = item
+            try:
+                cv2.imwrite(path, render(*args))
+            except Exception as e:
+                print(f"[debug-sink] could not write {path}: {e}")
+
+
+def render_detections(image_bgr, boxes, labels):
+    """Draws XYXY boxes and their labels on a copy of a BGR image."""
+    frame = image_bgr.copy()
+    for (x1, y1, x2, y2), label in zip(np.asarray(boxes).astype(int), labels):
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
+        cv2.putText(frame, label, (x1, max(y1 - 5, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
+    return frame
+
+
+def render_mask(image_bgr, box, mask, color=(255, 144, 30), alpha=0.8):
+    """Blends an HxW mask over a BGR image and draws its XYXY box prompt."""
+    mask = np.asarray(mask) > 0
+    frame = image_bgr.copy()
+    frame[mask] = (frame[mask] * (1 - alpha) + np.asarray(color) * alpha).astype(np.uint8)
+    x1, y1, x2, y2 = np.asarray(box).astype(int)
+    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 3)
+    return frame
+
+
+# Process-wide sink, disabled until configured
+debug_sink = DebugSink()
@@ -1,11 +1,9 @@
-import cv2
-import numpy as np
-import supervision as sv
-
 import torch
 import torchvision
 
 from groundingdino.util.inference import Model
+from image_handle import ImageHandle
+from debug_sink import debug_sink, render_detections
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -22,10 +20,11 @@ BOX_THRESHOLD = 0.25
 TEXT_THRESHOLD = 0.25
 NMS_THRESHOLD = 0.8
 
-def grounded(image_path, text_prompt, grounding_dino_model):
+def grounded(image, text_prompt, grounding_dino_model):
     CLASSES = [text_prompt]
-    # load image
-    image = cv2.imread(image_path)
+    # load image (accepts a path, a decoded BGR array or an ImageHandle)
+    handle = ImageHandle.of(image)
+    image = handle.bgr
     
     # detect objects
     detections = grounding_dino_model.predict_with_classes(
@@ -35,16 +34,14 @@ def grounded(image_path, text_prompt, grounding_dino_model):
         text_threshold=TEXT_THRESHOLD
     )
     
-    # annotate image with detections
-    box_annotator = sv.BoxAnnotator()
-    labels = [
-        f"{CLASSES[class_id]} {confidence:0.2f}" 
-        for _, _, confidence, class_id, _, _ 
-        in detections]
-    annotated_frame = box_annotator.annotate(scene=image.copy(), detections=detections, labels=labels)
-    
-    # save the annotated grounding dino image
-    cv2.imwrite("after_grounded.png", annotated_frame)
+    # annotate a sample of the images with their detections on the debug sink's thread
+    if debug_sink.sampled(handle):
+        # class_id is -1 for boxes with no class token above TEXT_THRESHOLD
+        labels = [
+            f"{CLASSES[class_id] if class_id >= 0 else 'unknown'} {confidence:0.2f}" 
+            for class_id, confidence
+            in zip(detections.class_id, detections.confidence)]
+        debug_sink.submit("after_grounded", handle.path, render_detections, image, detections.xyxy.copy(), labels)
     
     # NMS post process
     nms_idx = torchvision.ops.nms(
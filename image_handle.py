@@ -0,0 +1,81 @@
+import cv2
+import numpy as np
+
+
+class ImageHandle:
+    """
+    Decodes an image once and hands out views of the decoded pixels, so that
+    detection, segmentation and compositing share a single decode.
+
+    The decoded buffer is kept in BGR order (as returned by cv2). `rgb` is a
+    channel-reversed view of the same buffer and never copies.
+
+    Usage:
+        image = ImageHandle.from_path("garment.jpg")
+        detections = grounded(image, "jacket, shirt", grounding_dino_model)
+        masks, _ = robust_sam_boxes(image, detections.xyxy, sam_model, sam_transform)
+        segmented = image.composite(masks[0])
+    """
+
+    def __init__(self, path=None, bgr=None):
+        assert path is not None or bgr is not None, "ImageHandle needs a path or a decoded BGR array."
+        self.path = path
+        self._bgr = bgr
+        # whether the debug images of this image are written, decided once by debug_sink.sampled
+        self.debug = None
+
+    @classmethod
+    def from_path(cls, path):
+        return cls(path=path)
+
+    @classmethod
+    def from_bgr(cls, bgr):
+        return cls(bgr=bgr)
+
+    @classmethod
+    def of(cls, image):
+        """Wraps a path, a decoded BGR array or an existing handle."""
+        if isinstance(image, cls):
+            return image
+        if isinstance(image, str):
+            return cls.from_path(image)
+        return cls.from_bgr(image)
+
+    def decode(self):
+        """Decodes the image if that has not happened yet and returns the handle."""
+        if self._bgr is None:
+            bgr = cv2.imread(self.path)
+            if bgr is None:
+                raise ValueError(f"could not decode {self.path}")
+            self._bgr = bgr
+        return self
+
+    @property
+    def bgr(self):
+        """HxWx3 uint8 array in BGR order."""
+        return self.decode()._bgr
+
+    @property
+    def rgb(self):
+        """HxWx3 uint8 view in RGB order (negative channel stride, no copy)."""
+        return self.bgr[..., ::-1]
+
+    @property
+    def shape(self):
+        return self.bgr.shape
+
+    def composite(self, mask, background=255):
+        """
+        Keeps the pixels selected by `mask` and fills the rest with `background`.
+
+        Arguments:
+          mask (PIL.Image or np.ndarray): HxW mask, non-zero where the object is.
+          background (int): value used for every channel outside the mask.
+
+        Returns:
+          (np.ndarray): HxWx3 uint8 composite in RGB order.
+        """
+        mask = np.asarray(mask)
+        if mask.ndim == 3:
+            mask = mask[..., 0]
+        return np.where(mask[..., None] > 0, self.rgb, np.uint8(background))
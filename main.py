@@ -9,105 +9,199 @@
 
 # Required Imports
 from grounded import grounded, create_grounded_model
-from robust_sam import robust_sam, create_sam_model
+from robust_sam import robust_sam_boxes, create_sam_model
+from pipeline import Pipeline, Stage
+from image_handle import ImageHandle
+from debug_sink import debug_sink
 import os
 import shutil  # Added for directory removal
 from PIL import Image
 import json
+import threading
 import warnings
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import multiprocessing
 import time
 
 warnings.filterwarnings("ignore")
 
-# Global variables for models (to be initialized in each worker)
+# Concurrency of each pipeline stage. The model stages share one copy of each
+# model, so they are kept at a single worker; the I/O stages can fan out.
+DECODE_WORKERS = 4
+DETECT_WORKERS = 1
+SEGMENT_WORKERS = 1
+WRITE_WORKERS = 2
+QUEUE_SIZE = 8  # maximum number of garments waiting in front of each stage
+REPORT_INTERVAL = 10.0  # seconds between per-stage throughput reports
+
+# Segment and write every post-NMS box, the first one under the usual file names and the
+# others with an index suffix under the garment's "additional_garments". Off by default,
+# which keeps the output files and metadata of a single garment per image.
+WRITE_ALL_BOXES = False
+
+# Debug images (detections, mask overlays) for 1 in DEBUG_EVERY images, disabled when DEBUG_DIR is None
+DEBUG_DIR = None
+DEBUG_EVERY = 100
+
+# Global variables for models (initialized once in the main process)
 grounding_dino_model = None
 sam_model = None
 sam_transform = None
 
 def initializer():
     """
-    Initializes the models for each worker process.
-    This function is called once per worker when the pool starts.
+    Initializes the models shared by the detection and segmentation stages.
     """
     global grounding_dino_model, sam_model, sam_transform
     grounding_dino_model = create_grounded_model()
     sam_model, sam_transform = create_sam_model()
-    print(f"Worker {multiprocessing.current_process().name} initialized models.")
+    print("Initialized models.")
 
-def process_entry(entry, entry_number, mask_folder_path, output_folder_path):
+class EntryTracker:
     """
-    Processes a single metadata entry focusing only on garment data.
-    Returns the updated metadata dictionary.
+    Collects the garments of one metadata entry while they travel through the
+    pipeline and hands the updated entry back once the last one is finished.
     """
-    try:
-        updated_entry = entry.copy()
-        
-        # Process Garment Images if flag is True
-        if entry.get("process_garment_image", False):
-            garments = entry.get("garment_data", [])
-            for idx, garment in enumerate(garments):
-                garment_img_path = garment.get("image")
-                if garment_img_path and os.path.exists(garment_img_path):
-                    filename = os.path.basename(garment_img_path)
-                    print(f"[Entry {entry_number}, Garment {idx + 1}] Processing {filename}...")
-                    
-                    # Generate expected mask and segment filenames
-                    mask_filename = f"{os.path.splitext(filename)[0]}_mask.png"
-                    mask_path = os.path.join(mask_folder_path, mask_filename)
-                    
-                    segment_filename = f"{os.path.splitext(filename)[0]}_segmented.png"
-                    segment_path = os.path.join(output_folder_path, segment_filename)
-                    
-                    # Check if mask and segment already exist
-                    if os.path.exists(mask_path) and os.path.exists(segment_path):
-                        print(f"[Entry {entry_number}, Garment {idx + 1}] Mask and segmented images already exist. Skipping.")
-                        updated_entry["garment_data"][idx]["mask_file_path"] = os.path.abspath(mask_path)
-                        updated_entry["garment_data"][idx]["segment_file_path"] = os.path.abspath(segment_path)
-                        updated_entry["garment_data"][idx]["shirt_detected"] = True
-                        continue
-                    
-                    # Detect shirt in garment image
-                    detections = grounded(garment_img_path, "jacket, shirt", grounding_dino_model)
-                    
-                    if len(detections.xyxy) > 0:
-                        bbox = detections.xyxy[0]
-                        mask = robust_sam(garment_img_path, bbox, sam_model, sam_transform)
-                        
-                        # Save the mask
-                        mask.save(mask_path)
-                        
-                        # Create segmented image
-                        instance_img = Image.open(garment_img_path).convert("RGBA")
-                        mask = mask.convert("L")
-                        white_background = Image.new("RGB", instance_img.size, (255, 255, 255))
-                        composite_img = Image.composite(instance_img, white_background, mask)
-                        composite_img.save(segment_path)
-                        
-                        # Update metadata
-                        updated_entry["garment_data"][idx]["mask_file_path"] = os.path.abspath(mask_path)
-                        updated_entry["garment_data"][idx]["segment_file_path"] = os.path.abspath(segment_path)
-                        updated_entry["garment_data"][idx]["shirt_detected"] = True
-                        
-                        print(f"[Entry {entry_number}, Garment {idx + 1}] Processed: Mask and segmented images saved.")
-                    else:
-                        print(f"[Entry {entry_number}, Garment {idx + 1}] No 'shirt' detected.")
-                        updated_entry["garment_data"][idx]["mask_file_path"] = None
-                        updated_entry["garment_data"][idx]["segment_file_path"] = None
-                        updated_entry["garment_data"][idx]["shirt_detected"] = False
-                else:
-                    print(f"[Entry {entry_number}, Garment {idx + 1}] Garment image path does not exist: {garment_img_path}. Skipping.")
-                    updated_entry["garment_data"][idx]["mask_file_path"] = None
-                    updated_entry["garment_data"][idx]["segment_file_path"] = None
-                    updated_entry["garment_data"][idx]["shirt_detected"] = False
-        
-        return updated_entry
-    
-    except Exception as e:
-        print(f"[Entry {entry_number}] An error occurred while processing: {e}.")
+
+    def __init__(self, entry, entry_number, on_done):
+        self.updated_entry = entry.copy()
+        self.entry_number = entry_number
+        self.failed = False
+        self._pending = 0
+        self._on_done = on_done
+        self._lock = threading.Lock()
+
+    def set_garment_result(self, idx, mask_path, segment_path, detected):
+        garment = self.updated_entry["garment_data"][idx]
+        garment["mask_file_path"] = os.path.abspath(mask_path) if mask_path else None
+        garment["segment_file_path"] = os.path.abspath(segment_path) if segment_path else None
+        garment["shirt_detected"] = detected
+
+    def expect(self, count):
+        self._pending = count
+        if count == 0:
+            self._on_done(self)
+
+    def garment_done(self, failed=False):
+        with self._lock:
+            self.failed = self.failed or failed
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished:
+            self._on_done(self)
+
+def schedule_entry(tracker, pipeline, mask_folder_path, output_folder_path):
+    """
+    Resolves the garments of an entry that need no model work (missing images,
+    already processed outputs) and submits the remaining ones to the pipeline.
+    """
+    entry_number = tracker.entry_number
+    tasks = []
+
+    # Process Garment Images if flag is True
+    if tracker.updated_entry.get("process_garment_image", False):
+        garments = tracker.updated_entry.get("garment_data", [])
+        for idx, garment in enumerate(garments):
+            garment_img_path = garment.get("image")
+            if garment_img_path and os.path.exists(garment_img_path):
+                filename = os.path.basename(garment_img_path)
+                print(f"[Entry {entry_number}, Garment {idx + 1}] Processing {filename}...")
+
+                # Generate expected mask and segment filenames
+                mask_filename = f"{os.path.splitext(filename)[0]}_mask.png"
+                mask_path = os.path.join(mask_folder_path, mask_filename)
+
+                segment_filename = f"{os.path.splitext(filename)[0]}_segmented.png"
+                segment_path = os.path.join(output_folder_path, segment_filename)
+
+                # Check if mask and segment already exist
+                if os.path.exists(mask_path) and os.path.exists(segment_path):
+                    print(f"[Entry {entry_number}, Garment {idx + 1}] Mask and segmented images already exist. Skipping.")
+                    tracker.set_garment_result(idx, mask_path, segment_path, True)
+                    continue
+
+                tasks.append({
+                    "tracker": tracker,
+                    "idx": idx,
+                    "image_path": garment_img_path,
+                    "mask_path": mask_path,
+                    "segment_path": segment_path,
+                })
+            else:
+                print(f"[Entry {entry_number}, Garment {idx + 1}] Garment image path does not exist: {garment_img_path}. Skipping.")
+                tracker.set_garment_result(idx, None, None, False)
+
+    tracker.expect(len(tasks))
+    for task in tasks:
+        pipeline.submit(task)
+
+def decode_stage(task):
+    """Reads and decodes the garment image from disk, once for every later stage."""
+    task["image"] = ImageHandle.from_path(task["image_path"]).decode()
+    # one sampling decision per image, read by the detection and segmentation stages
+    debug_sink.sampled(task["image"])
+    return task
+
+def detect_stage(task):
+    """Detects the garment with GroundingDINO; drops the task if nothing is found."""
+    tracker, idx = task["tracker"], task["idx"]
+
+    # Detect shirt in garment image
+    detections = grounded(task["image"], "jacket, shirt", grounding_dino_model)
+
+    if len(detections.xyxy) == 0:
+        print(f"[Entry {tracker.entry_number}, Garment {idx + 1}] No 'shirt' detected.")
+        tracker.set_garment_result(idx, None, None, False)
+        tracker.garment_done()
         return None
 
+    # the first box is the primary garment, the others are only segmented with WRITE_ALL_BOXES
+    task["boxes"] = detections.xyxy if WRITE_ALL_BOXES else detections.xyxy[:1]
+    return task
+
+def segment_stage(task):
+    """Segments all detected boxes with RobustSAM in one encoder pass and one decoder call."""
+    task["masks"], task["iou_predictions"] = robust_sam_boxes(task["image"], task["boxes"], sam_model, sam_transform)
+    return task
+
+def write_stage(task):
+    """Saves the mask and the segmented image, then updates the metadata."""
+    tracker, idx = task["tracker"], task["idx"]
+    mask_stem, mask_ext = os.path.splitext(task["mask_path"])
+    segment_stem, segment_ext = os.path.splitext(task["segment_path"])
+
+    additional_garments = []
+    for k, mask in enumerate(task["masks"]):
+        # The first box keeps the original file names, the others get an index suffix
+        suffix = f"_{k}" if k > 0 else ""
+        mask_path = f"{mask_stem}{suffix}{mask_ext}"
+        segment_path = f"{segment_stem}{suffix}{segment_ext}"
+
+        # Save the mask
+        mask.save(mask_path)
+
+        # Create segmented image on a white background from the already decoded pixels
+        composite_img = Image.fromarray(task["image"].composite(mask.convert("L")))
+        composite_img.save(segment_path)
+
+        if k > 0:
+            additional_garments.append({
+                "mask_file_path": os.path.abspath(mask_path),
+                "segment_file_path": os.path.abspath(segment_path),
+                "iou_prediction": float(task["iou_predictions"][k]),
+            })
+
+    # Update metadata
+    tracker.set_garment_result(idx, task["mask_path"], task["segment_path"], True)
+    if additional_garments:
+        tracker.updated_entry["garment_data"][idx]["additional_garments"] = additional_garments
+    print(f"[Entry {tracker.entry_number}, Garment {idx + 1}] Processed: Mask and segmented images saved.")
+    tracker.garment_done()
+    return None
+
+def on_stage_error(stage_name, task, e):
+    tracker = task["tracker"]
+    print(f"[Entry {tracker.entry_number}, Garment {task['idx'] + 1}] An error occurred in stage '{stage_name}': {e}.")
+    tracker.garment_done(failed=True)
+
 def main():
     # Paths
     metadata_file_path = "./chuan_metadata.json"  # Ensure this is your metadata file path
@@ -141,29 +235,42 @@ def main():
         print(f"Error loading metadata file: {e}")
         return  # Exit the main function if metadata loading fails
     
-    # List to store the results
-    results = []
-    
+    initializer()
+
+    # Updated entries, keyed by entry number so the output keeps the input order
+    results = {}
+    results_lock = threading.Lock()
+
+    def on_entry_done(tracker):
+        if tracker.failed:
+            print(f"[Entry {tracker.entry_number}] An error occurred while processing, entry dropped.")
+            return
+        with results_lock:
+            results[tracker.entry_number] = tracker.updated_entry
+
+    pipeline = Pipeline(
+        [
+            Stage("decode", decode_stage, workers=DECODE_WORKERS, queue_size=QUEUE_SIZE),
+            Stage("detect", detect_stage, workers=DETECT_WORKERS, queue_size=QUEUE_SIZE),
+            Stage("segment", segment_stage, workers=SEGMENT_WORKERS, queue_size=QUEUE_SIZE),
+            Stage("write", write_stage, workers=WRITE_WORKERS, queue_size=QUEUE_SIZE),
+        ],
+        on_error=on_stage_error,
+        report_interval=REPORT_INTERVAL,
+    )
+
     start_time = time.time()
-    
-    # Use ProcessPoolExecutor with 3 workers
-    with ProcessPoolExecutor(max_workers=3, initializer=initializer) as executor:
-        # Submit all tasks to the executor
-        future_to_entry = {
-            executor.submit(process_entry, entry, idx + 1, mask_folder_path, output_folder_path): idx + 1
-            for idx, entry in enumerate(metadata)
-        }
-        
-        # Iterate over the completed futures as they finish
-        for future in as_completed(future_to_entry):
-            entry_number = future_to_entry[future]
-            try:
-                result = future.result()
-                if result is not None:
-                    results.append(result)
-            except Exception as exc:
-                print(f"[Entry {entry_number}] Generated an exception: {exc}")
-    
+
+    debug_sink.configure(DEBUG_DIR, DEBUG_EVERY)
+    pipeline.start()
+    for idx, entry in enumerate(metadata):
+        tracker = EntryTracker(entry, idx + 1, on_entry_done)
+        schedule_entry(tracker, pipeline, mask_folder_path, output_folder_path)
+    pipeline.close()
+    debug_sink.close()
+
+    results = [results[entry_number] for entry_number in sorted(results)]
+
     end_time = time.time()
     print(f"Processing completed in {end_time - start_time:.2f} seconds.")
     
@@ -176,13 +283,6 @@ def main():
         print(f"Error saving updated metadata: {e}")
 
 if __name__ == "__main__":
-    # Set the multiprocessing start method to 'spawn'
-    try:
-        multiprocessing.set_start_method('spawn')
-    except RuntimeError:
-        # If the start method has already been set, this will raise a RuntimeError
-        pass
-    
     start = time.time()
     
     while True:
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+
+# Sentinel pushed into a stage's input queue to stop one of its workers
+_STOP = object()
+
+
+class Stage:
+    """
+    A pool of worker threads that pulls items from a bounded input queue,
+    applies `fn` to each of them and pushes the result to the next stage.
+    `fn` may return None to drop an item (e.g. when it is already finished).
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=8):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.in_queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.on_error = None
+
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Waits until every queued item has gone through this stage."""
+        for _ in self._threads:
+            self.in_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is _STOP:
+                break
+
+            start = time.perf_counter()
+            try:
+                result = self.fn(item)
+                ok = True
+            except Exception as e:
+                result = None
+                ok = False
+                if self.on_error is not None:
+                    self.on_error(self.name, item, e)
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self.busy_time += elapsed
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+            if result is not None and self.next_stage is not None:
+                self.next_stage.in_queue.put(result)
+
+    def stats(self, wall_time):
+        """Returns a one-line throughput / queue depth summary for this stage."""
+        with self._lock:
+            processed, failed, busy_time = self.processed, self.failed, self.busy_time
+        rate = processed / wall_time if wall_time > 0 else 0.0
+        utilisation = busy_time / (wall_time * self.workers) if wall_time > 0 else 0.0
+        return (
+            f"[{self.name}] done={processed} failed={failed} "
+            f"throughput={rate:.2f} items/s utilisation={utilisation:.0%} "
+            f"queue={self.in_queue.qsize()}/{self.in_queue.maxsize} workers={self.workers}"
+        )
+
+
+class Pipeline:
+    """
+    Chains stages with bounded queues so that every stage runs concurrently:
+    while the model stages are busy, the I/O stages decode the next images and
+    write the previous results. A full queue blocks its producer, which keeps
+    memory bounded when one stage is slower than the others.
+
+    Usage:
+        pipeline = Pipeline([Stage("decode", decode, workers=4), ...], on_error=handle_error)
+        pipeline.start()
+        for item in items:
+            pipeline.submit(item)
+        pipeline.close()
+    """
+
+    def __init__(self, stages, on_error=None, report_interval=10.0):
+        self.stages = stages
+        self.report_interval = report_interval
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next_stage = next_stage
+            stage.on_error = on_error
+
+        self._start_time = None
+        self._closed = threading.Event()
+        self._reporter = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        if self.report_interval:
+            self._reporter = threading.Thread(target=self._report_loop, name="pipeline-report", daemon=True)
+            self._reporter.start()
+
+    def submit(self, item):
+        """Feeds an item into the first stage, blocking while its queue is full."""
+        self.stages[0].in_queue.put(item)
+
+    def close(self):
+        """Drains the stages in order and prints the final per-stage statistics."""
+        for stage in self.stages:
+            stage.stop()
+        self._closed.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        self.report()
+
+    def report(self):
+        wall_time = time.perf_counter() - self._start_time
+        for stage in self.stages:
+            print(stage.stats(wall_time))
+
+    def _report_loop(self):
+        while not self._closed.wait(self.report_interval):
+            self.report()
@@ -1,86 +1,135 @@
 import argparse
-from tqdm import tqdm
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from PIL import Image, ImageDraw
 import numpy as np
-import cv2
-import os
 import torch
-import torch.nn as nn
 from PIL import Image
 
-from robust_segment_anything import sam_model_registry
 from robust_segment_anything import sam_model_registry
 from robust_segment_anything.utils.transforms import ResizeLongestSide 
+from robust_segment_anything.utils.embedding_cache import EmbeddingCache, file_digest
+from robust_segment_anything.utils.optimize import optimize_for_inference
+from image_handle import ImageHandle
+from debug_sink import debug_sink, render_mask
 
-def show_boxes(coords, ax):
-    x1, y1, x2, y2 = coords
-    width = x2-x1
-    height = y2-y1    
-    bbox = patches.Rectangle((x1, y1), width, height, linewidth=3, edgecolor='r', facecolor='none')
-    ax.add_patch(bbox)
-   
-def show_mask(mask, ax, random_color=False):
-    if random_color:
-        color = np.concatenate([np.random.random(3), np.array([0.6])], axis=0)
-    else:
-        color = np.array([30/255, 144/255, 255/255, 0.8])
-        
-    h, w = mask.shape[-2:]    
-    mask = mask.detach().cpu().numpy()   
-    mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-    ax.imshow(mask_image)
-    
 opt = argparse.Namespace()
 opt.case = "clear"
 opt.gpu = 0
 opt.model_size = 'l'
 opt.checkpoint_path = "robustsam_checkpoint_l.pth"
 opt.checkpoint_path = 'robustsam_checkpoint_{}.pth'.format(opt.model_size)    
+# On-disk cache of image encoder outputs, disabled when the directory is None
+opt.embedding_cache_dir = None
+opt.embedding_cache_max_gb = 20
+# Fold normalisations and strip the clear=True decoder branch, Sam.predict decodes with clear=False
+opt.optimize_for_inference = True
+# Image encoder attention: "math" or "sdpa", which can also tile the queries to bound its memory
+# and needs torch >= 2.0 (cog.yaml still pins 1.13)
+opt.attn_impl = "sdpa" if hasattr(torch.nn.functional, "scaled_dot_product_attention") else "math"
+opt.attn_query_tile = 1024
+
+# Created by create_sam_model when opt.embedding_cache_dir is set
+sam_embedding_cache = None
 
 def create_sam_model():
-    sam_model = sam_model_registry["vit_{}".format(opt.model_size)](opt=opt, checkpoint=opt.checkpoint_path)
+    global sam_embedding_cache
+    sam_model = sam_model_registry["vit_{}".format(opt.model_size)](
+        opt=opt, checkpoint=opt.checkpoint_path, attn_impl=opt.attn_impl, attn_query_tile=opt.attn_query_tile
+    )
     sam_model = sam_model.to(opt.gpu)
+    if opt.optimize_for_inference:
+        sam_model = optimize_for_inference(sam_model, clear=False, inplace=True)
     print('Succesfully loading model from {}'.format(opt.checkpoint_path))
     sam_transform = ResizeLongestSide(sam_model.image_encoder.img_size)
 
+    if opt.embedding_cache_dir is not None:
+        sam_embedding_cache = EmbeddingCache(
+            opt.embedding_cache_dir,
+            checkpoint_digest=file_digest(opt.checkpoint_path),
+            max_bytes=int(opt.embedding_cache_max_gb * 1024 ** 3),
+        )
+        print('Using {} cached image embeddings from {}'.format(len(sam_embedding_cache), opt.embedding_cache_dir))
+
     return sam_model, sam_transform
 
 print('Use bounding box as prompt!')
 
-def robust_sam(image_path, box_prompt, sam_model, sam_transform):
-    image = cv2.imread(image_path)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) 
-    image_t = torch.tensor(image, dtype=torch.uint8).unsqueeze(0).to(opt.gpu)
-    image_t = torch.permute(image_t, (0, 3, 1, 2))
+def _predict_boxes(image, box_prompts, sam_model, sam_transform):
+    """
+    Runs RobustSAM on one image with an Nx4 array of XYXY boxes. The image is
+    encoded once and all N boxes go through the prompt encoder and the mask
+    decoder as a single batch.
+    """
+    # upload the shared BGR buffer as is and swap channels on the device
+    image_t = torch.from_numpy(image.bgr).unsqueeze(0).to(opt.gpu)
+    image_t = torch.permute(image_t, (0, 3, 1, 2)).flip(1)
     image_t_transformed = sam_transform.apply_image_torch(image_t.float())
 
     data_dict = {}      
-    box_t = torch.Tensor(box_prompt).unsqueeze(0).to(opt.gpu)
+    box_t = torch.as_tensor(np.asarray(box_prompts), dtype=torch.float).reshape(-1, 4).to(opt.gpu)
     data_dict['image'] = image_t_transformed
-    data_dict['boxes'] = sam_transform.apply_boxes_torch(box_t, image_t.shape[-2:]).unsqueeze(0)          
+    data_dict['boxes'] = sam_transform.apply_boxes_torch(box_t, image_t.shape[-2:])
     data_dict['original_size'] = image_t.shape[-2:]  
 
+    if sam_embedding_cache is not None:
+        # skip the image encoder for images that were already seen with this checkpoint
+        key = sam_embedding_cache.key(image.bgr)
+        cached = sam_embedding_cache.get(key, device=sam_model.device)
+        if cached is None:
+            with torch.no_grad():
+                image_embeddings, encoder_features = sam_model.image_encoder(sam_model.preprocess(image_t_transformed))
+            cached = image_embeddings[0], encoder_features[0][0]
+            sam_embedding_cache.put(key, *cached)
+        data_dict['image_embeddings'], data_dict['encoder_features'] = cached
+
     with torch.no_grad():   
         batched_output = sam_model.predict(opt, [data_dict], multimask_output=False, return_logits=False)    
 
-    output_mask = batched_output[0]['masks']
-    plt.figure(figsize=(10,10))
-    plt.imshow(image[:, :, ::-1])
+    return batched_output[0]
 
-    show_boxes(box_prompt, plt.gca())
-    show_mask(output_mask[0][0], plt.gca())
-    plt.axis('off')
-    plt.savefig("after_robust.png", bbox_inches='tight')
-
-    print('Finish inferencing...')
-
-    output_mask = output_mask.squeeze(0).squeeze(0)
+def _mask_to_pil(output_mask):
     # Chuyển tensor sang numpy array
     numpy_image = output_mask.cpu().numpy()
     # Chuyển đổi giá trị về khoảng [0, 255] nếu cần (tùy thuộc vào phạm vi của tensor ban đầu)
     numpy_image = (numpy_image * 255).astype(np.uint8)
-    mask_pil_image = Image.fromarray(numpy_image)
-    mask_pil_image.save("mask_pil_image.png")
-    return mask_pil_image
\ No newline at end of file
+    return Image.fromarray(numpy_image)
+
+def robust_sam_boxes(image, box_prompts, sam_model, sam_transform):
+    """
+    Segments every box of an image with a single encoder pass and a single
+    decoder call.
+
+    Arguments:
+      image: a path, a decoded BGR array or an ImageHandle.
+      box_prompts: Nx4 boxes in XYXY pixel coordinates, e.g. detections.xyxy.
+
+    Returns:
+      (list(PIL.Image)): one binary mask per box, in the order of box_prompts.
+      (np.ndarray): the predicted IoU of each mask, with shape N.
+    """
+    # accepts a path, a decoded BGR array or an ImageHandle
+    image = ImageHandle.of(image)
+    output = _predict_boxes(image, box_prompts, sam_model, sam_transform)
+
+    masks = [_mask_to_pil(mask[0]) for mask in output['masks']]
+    iou_predictions = output['iou_predictions'][:, 0].cpu().numpy()
+    _submit_debug(image, box_prompts, masks)
+    return masks, iou_predictions
+
+def _submit_debug(image, box_prompts, masks):
+    # overlay and raw mask of a sample of the images, rendered on the debug sink's thread
+    if not debug_sink.sampled(image):
+        return
+    for k, (box, mask) in enumerate(zip(np.asarray(box_prompts).reshape(-1, 4), masks)):
+        mask = np.asarray(mask)
+        debug_sink.submit(f"after_robust_{k}", image.path, render_mask, image.bgr, box, mask)
+        debug_sink.submit(f"mask_{k}", image.path, np.asarray, mask)
+
+def robust_sam(image, box_prompt, sam_model, sam_transform):
+    # accepts a path, a decoded BGR array or an ImageHandle
+    image = ImageHandle.of(image)
+    output_mask = _predict_boxes(image, [box_prompt], sam_model, sam_transform)['masks']
+
+    print('Finish inferencing...')
+
+    mask_pil_image = _mask_to_pil(output_mask.squeeze(0).squeeze(0))
+    _submit_debug(image, [box_prompt], [mask_pil_image])
+    return mask_pil_image
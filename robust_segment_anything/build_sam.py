@@ -11,7 +11,7 @@ from functools import partial
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
 from collections import OrderedDict
 
-def build_sam_vit_h(opt, checkpoint=None, train=False):
+def build_sam_vit_h(opt, checkpoint=None, train=False, attn_impl="math", attn_query_tile=None):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
@@ -20,9 +20,11 @@ def build_sam_vit_h(opt, checkpoint=None, train=False):
         checkpoint=checkpoint,
         train=train,
         opt=opt,
+        attn_impl=attn_impl,
+        attn_query_tile=attn_query_tile,
     )
 
-def build_sam_vit_l(opt, checkpoint=None, train=False):
+def build_sam_vit_l(opt, checkpoint=None, train=False, attn_impl="math", attn_query_tile=None):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
@@ -31,10 +33,12 @@ def build_sam_vit_l(opt, checkpoint=None, train=False):
         checkpoint=checkpoint,
         train=train,
         opt=opt,
+        attn_impl=attn_impl,
+        attn_query_tile=attn_query_tile,
     )
 
 
-def build_sam_vit_b(opt, checkpoint=None, train=False):
+def build_sam_vit_b(opt, checkpoint=None, train=False, attn_impl="math", attn_query_tile=None):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
@@ -43,6 +47,8 @@ def build_sam_vit_b(opt, checkpoint=None, train=False):
         checkpoint=checkpoint,
         train=train,
         opt=opt,
+        attn_impl=attn_impl,
+        attn_query_tile=attn_query_tile,
     )
 
 
@@ -62,6 +68,8 @@ def _build_sam(
     checkpoint=None,
     train=False,
     opt=None,
+    attn_impl="math",
+    attn_query_tile=None,
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -81,6 +89,8 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            attn_impl=attn_impl,
+            attn_query_tile=attn_query_tile,
         ),
         prompt_encoder=PromptEncoder(
             embed_dim=prompt_embed_dim,
@@ -89,7 +89,8 @@ class TokenBlock(nn.Module):
     def forward(self, x, mlp=True):
         x = self.IN_layer_I(x)
         x = self.IN_layer_II(x)
-        x = x.view(self.input_dim, -1)
+        # one row of input_dim robust tokens per prompt
+        x = x.view(x.shape[0], self.input_dim, -1)
         output = self.mlp(x)
 
         return output
@@ -206,18 +207,17 @@ class FGMBlock(nn.Module):
         self.conv_layer = nn.Conv2d(self.num_channels, self.num_channels, kernel_size=1)
 
     def forward(self, x):
-        fft_map = torch.fft.fft2(x, dim=(-2, -1))
-        
+        # the 1x1 conv keeps the spectrum Hermitian, so the half spectrum is enough
+        fft_map = torch.fft.rfft2(x, dim=(-2, -1))
+
         magnitude_map = torch.abs(fft_map)
-        phase_map = torch.angle(fft_map)
-        
         modified_magnitude = self.conv_layer(magnitude_map)
-        
-        real_part = modified_magnitude * torch.cos(phase_map)
-        imag_part = modified_magnitude * torch.sin(phase_map)
-        modified_fft_map = torch.complex(real_part, imag_part)
 
-        reconstructed_x = torch.real(torch.fft.ifft2(modified_fft_map, dim=(-2, -1)))
-        
-        return reconstructed_x
+        # same phase, new magnitude; a zero coefficient has phase 0 as in torch.angle
+        zero = magnitude_map == 0
+        scale = modified_magnitude / magnitude_map.masked_fill(zero, 1)
+        modified_fft_map = fft_map.masked_fill(zero, 1) * scale
 
+        reconstructed_x = torch.fft.irfft2(modified_fft_map, s=x.shape[-2:], dim=(-2, -1))
+
+        return reconstructed_x
@@ -33,6 +33,9 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        feature_indexes: Optional[Tuple[int, ...]] = None,
+        attn_impl: str = "math",
+        attn_query_tile: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -51,9 +54,15 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            feature_indexes (tuple or None): Which global-attention block outputs,
+                counted among the global-attention blocks, forward returns as
+                intermediate features, in that order. None returns all of them.
+            attn_impl (str): Attention implementation of every block, see Attention.
+            attn_query_tile (int or None): Query tile size of the "sdpa" attention.
         """
         super().__init__()
         self.img_size = img_size
+        self.feature_indexes = feature_indexes
 
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
@@ -82,6 +91,8 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_impl=attn_impl,
+                attn_query_tile=attn_query_tile,
             )
             self.blocks.append(block)
 
@@ -109,15 +120,21 @@ class ImageEncoderViT(nn.Module):
         if self.pos_embed is not None:
             x = x + self.pos_embed
 
-        encoder_features = []
-        
+        encoder_features = {}
+        num_global = 0
+
         for blk in self.blocks:
             x = blk(x)
             if blk.window_size == 0: # global attention
-                encoder_features.append(x) # return intermediate embeddings
+                # only keep the intermediate embeddings that are returned alive
+                if self.feature_indexes is None or num_global in self.feature_indexes:
+                    encoder_features[num_global] = x
+                num_global += 1
 
         x = self.neck(x.permute(0, 3, 1, 2))
-        return x, encoder_features
+        if self.feature_indexes is None:
+            return x, list(encoder_features.values())
+        return x, [encoder_features[i] for i in self.feature_indexes]
 
 
 class Block(nn.Module):
@@ -135,6 +152,8 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_impl: str = "math",
+        attn_query_tile: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -150,6 +169,8 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_impl (str): Attention implementation, see Attention.
+            attn_query_tile (int or None): Query tile size of the "sdpa" attention.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -160,6 +181,8 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            impl=attn_impl,
+            query_tile=attn_query_tile,
         )
 
         self.norm2 = norm_layer(dim)
@@ -197,6 +220,8 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        impl: str = "math",
+        query_tile: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -207,8 +232,23 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            impl (str): "math" forms the attention matrix explicitly. "sdpa" runs
+                F.scaled_dot_product_attention with the relative position bias as an
+                additive mask.
+            query_tile (int or None): With "sdpa", the number of queries, rounded down
+                to whole rows of the feature map, attended to at once, so that the
+                peak memory of the bias and of the attention scales with the tile
+                instead of with (H * W)^2. None attends to all queries at once.
         """
         super().__init__()
+        if impl not in ("math", "sdpa"):
+            raise ValueError(f"Unknown attention implementation '{impl}', expected 'math' or 'sdpa'.")
+        if impl == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            raise ValueError("The 'sdpa' attention requires torch>=2.0.")
+        if query_tile is not None and query_tile <= 0:
+            raise ValueError(f"query_tile must be positive, got {query_tile}.")
+        self.impl = impl
+        self.query_tile = query_tile
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
@@ -232,6 +272,11 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
+        if self.impl == "sdpa":
+            x = self.sdpa_attention(q, k, v, (H, W))
+            x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+            return self.proj(x)
+
         attn = (q * self.scale) @ k.transpose(-2, -1)
 
         if self.use_rel_pos:
@@ -243,6 +288,27 @@ class Attention(nn.Module):
 
         return x
 
+    def sdpa_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, size: Tuple[int, int]
+    ) -> torch.Tensor:
+        """Attention of (B * nHead, H * W, C) q, k, v over tiles of whole query rows."""
+        H, W = size
+        rows = H if self.query_tile is None else max(self.query_tile // W, 1)
+        if self.use_rel_pos:
+            Rh = get_rel_pos(H, H, self.rel_pos_h)
+            Rw = get_rel_pos(W, W, self.rel_pos_w)
+
+        outputs = []
+        for start in range(0, H, rows):
+            end = min(start + rows, H)
+            q_tile = q[:, start * W : end * W]
+            bias = None
+            if self.use_rel_pos:
+                bias = decomposed_rel_pos_bias(q_tile, Rh[start:end], Rw, (end - start, W), (H, W))
+            # the default scale of scaled_dot_product_attention is head_dim**-0.5, i.e. self.scale
+            outputs.append(F.scaled_dot_product_attention(q_tile, k, v, attn_mask=bias))
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=1)
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -365,6 +431,37 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def decomposed_rel_pos_bias(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> torch.Tensor:
+    """
+    The decomposed relative positional embeddings that add_decomposed_rel_pos adds to
+    the attention map, as a separate additive bias.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): relative positional embeddings of the query rows (q_h, k_h, C), from get_rel_pos.
+        Rw (Tensor): relative positional embeddings of the query columns (q_w, k_w, C), from get_rel_pos.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        bias (Tensor): attention bias with shape (B, q_h * q_w, k_h * k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+
+    return (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
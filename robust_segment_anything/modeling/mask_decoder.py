@@ -15,6 +15,13 @@ from .components import *
 
 
 class MaskDecoder(nn.Module):
+    # the only 'clear' supported once utils.optimize.optimize_for_inference has stripped the
+    # modules of the other one, None for all
+    inference_clear = None
+    # the intermediate features of the image encoder the decoder reads, counted among its
+    # global-attention blocks: only the first one
+    encoder_feature_indexes = (0,)
+
     def __init__(
         self,
         *,
@@ -95,9 +102,10 @@ class MaskDecoder(nn.Module):
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
         multimask_output: bool,
-        encoder_features: torch.Tensor, #TODO:
+        encoder_features: torch.Tensor = None, #TODO:
         robust_token_only: bool = False,
         clear: bool = True,
+        robust_features: torch.Tensor = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Predict masks given image and prompt embeddings.
@@ -109,18 +117,20 @@ class MaskDecoder(nn.Module):
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
           multimask_output (bool): Whether to return multiple masks or a single
             mask.
+          encoder_features (torch.Tensor): the intermediate features of the image
+            encoder, whose first element is the BxHxWxC first-layer feature map.
+            Not needed when robust_features is given.
+          robust_features (torch.Tensor or None): the output of
+            'get_robust_features' for this image and the same 'clear', to skip
+            the image-level AMFG stage when decoding several prompts.
 
         Returns:
           torch.Tensor: batched predicted masks
           torch.Tensor: batched predictions of mask quality
         """
-        early_features = encoder_features[0].permute(0, 3, 1, 2) 
-
-        # pass image features of different level through AMFG
-        complementary_features = self.fourier_first_layer_features(early_features, clear=clear) 
-        final_image_embeddings = self.fourier_last_layer_features(image_embeddings, clear=clear)
-
-        robust_features = complementary_features + final_image_embeddings # fuse image's complementary features and final embeddings 
+        self._check_clear(clear)
+        if robust_features is None:
+            robust_features = self.get_robust_features(image_embeddings, encoder_features[0], clear=clear)
 
         masks, iou_pred, upscaled_embedding_robust, robust_token, token_att_map = self.predict_masks(
             image_embeddings=image_embeddings,
@@ -142,6 +152,44 @@ class MaskDecoder(nn.Module):
         # Prepare output
         return masks, iou_pred, upscaled_embedding_robust, robust_token
 
+    def get_robust_features(
+        self,
+        image_embeddings: torch.Tensor,
+        early_features: torch.Tensor,
+        clear: bool = True,
+    ) -> torch.Tensor:
+        """
+        Image-level stage of the decoder: passes the first-layer and the final
+        features of the image encoder through AMFG and fuses them. The result
+        does not depend on the prompts, so it can be computed once per image
+        and passed to 'forward' for every set of prompts.
+
+        Arguments:
+          image_embeddings (torch.Tensor): the embeddings from the image encoder,
+            in BxCxHxW format
+          early_features (torch.Tensor): the first-layer feature map of the
+            image encoder, in BxHxWxC format
+          clear (bool): whether the features are for the original SAM output
+            tokens or for the robust output tokens
+
+        Returns:
+          torch.Tensor: the robust features, in Bx(C/8)x4Hx4W format
+        """
+        self._check_clear(clear)
+        early_features = early_features.permute(0, 3, 1, 2)
+
+        # pass image features of different level through AMFG
+        complementary_features = self.fourier_first_layer_features(early_features, clear=clear)
+        final_image_embeddings = self.fourier_last_layer_features(image_embeddings, clear=clear)
+
+        return complementary_features + final_image_embeddings # fuse image's complementary features and final embeddings
+
+    def _check_clear(self, clear: bool) -> None:
+        if self.inference_clear is not None and clear != self.inference_clear:
+            raise ValueError(
+                f"This mask decoder was optimized for clear={self.inference_clear} and cannot run with clear={clear}."
+            )
+
     def predict_masks(
         self,
         image_embeddings: torch.Tensor,
@@ -178,10 +226,9 @@ class MaskDecoder(nn.Module):
         src = src.transpose(1, 2).view(b, c, h, w)
         upscaled_embedding_decoder = self.output_upscaling(src) # decoder output mask features
 
-        robust_features = robust_features.repeat(b,1,1,1)       
         mask_features = self.fourier_mask_features(upscaled_embedding_decoder, clear=clear) # pass original mask features through AMFG
        
-        upscaled_embedding_robust = mask_features + robust_features # fuse image features and mask features
+        upscaled_embedding_robust = mask_features + robust_features # fuse image features and mask features, broadcast over the prompts
 
         hyper_in_list: List[torch.Tensor] = []
 
@@ -194,7 +241,11 @@ class MaskDecoder(nn.Module):
                 token = self.custom_token_block(token)
                 hyper_in_list.append(self.robust_mlp(token))
         
-        hyper_in = torch.stack(hyper_in_list, dim=1)
+        if clear:
+            hyper_in = torch.stack(hyper_in_list, dim=1)
+        else:
+            # every ROT expands into num_mask_tokens hypernetwork rows per prompt
+            hyper_in = torch.stack(hyper_in_list, dim=2).flatten(1, 2)
         b, c, h, w = upscaled_embedding_decoder.shape
 
         # at inference stage, clear=False
@@ -42,6 +42,9 @@ class Sam(nn.Module):
         self.image_encoder = image_encoder
         self.prompt_encoder = prompt_encoder
         self.mask_decoder = mask_decoder
+        # the encoder only keeps the intermediate features the decoder declares it reads
+        if self.image_encoder.feature_indexes is None:
+            self.image_encoder.feature_indexes = tuple(self.mask_decoder.encoder_feature_indexes)
         self.register_buffer("pixel_mean", torch.Tensor(pixel_mean).view(-1, 1, 1), False)
         self.register_buffer("pixel_std", torch.Tensor(pixel_std).view(-1, 1, 1), False)
 
@@ -160,10 +163,47 @@ class Sam(nn.Module):
         return_logits: bool = False,
         robust_token_only: bool = False,
     ) -> List[Dict[str, torch.Tensor]]:
+        """
+        Predicts masks at inference time for a batch of images. Every image is
+        normalized and padded to a square input, the images are stacked and
+        the image encoder runs once on the whole Bx3xHxW batch. The prompts of
+        each record are then decoded against that record's own embedding and
+        first-layer features.
+
+        Arguments:
+          batched_input (list(dict)): A list over input images, with the same
+            keys as in 'forward'. 'image' may be given in 3xHxW or 1x3xHxW
+            format, already transformed for input to the model. Records may
+            also carry precomputed encoder outputs, in which case their image
+            is not encoded again:
+              'image_embeddings': (torch.Tensor) The image encoder output,
+                in CxHxW format.
+              'encoder_features': (torch.Tensor) The first global-attention
+                feature map of the image encoder, in HxWxC format.
+              'robust_features': (torch.Tensor) The output of
+                'mask_decoder.get_robust_features' for the image, in CxHxW
+                format. It is returned by this method, so that further
+                prompts on the same image skip the image-level AMFG stage.
+          multimask_output (bool): Whether the model should predict multiple
+            disambiguating masks, or return a single mask.
 
-        input_images = self.preprocess(batched_input[0]['image'])
-        image_embeddings, encoder_features = self.image_encoder(input_images)
-        encoder_features = encoder_features[0]  # supplementary feature
+        Returns:
+          (list(dict)): A list over input images, with the same keys as
+            returned by 'forward' and the 'robust_features' of the image.
+        """
+        image_embeddings = [x.get("image_embeddings") for x in batched_input]
+        encoder_features = [x.get("encoder_features") for x in batched_input]
+
+        to_encode = [i for i, x in enumerate(image_embeddings) if x is None]
+        if len(to_encode) > 0:
+            input_images = [self.preprocess(batched_input[i]["image"]) for i in to_encode]
+            input_images = torch.cat([x if x.dim() == 4 else x[None] for x in input_images], dim=0)
+            assert input_images.shape[0] == len(to_encode), "Each record must hold exactly one image."
+            new_embeddings, new_features = self.image_encoder(input_images)
+            new_features = new_features[0]  # supplementary feature
+            for j, i in enumerate(to_encode):
+                image_embeddings[i] = new_embeddings[j]
+                encoder_features[i] = new_features[j]
         
         outputs = []
 
@@ -179,15 +219,22 @@ class Sam(nn.Module):
                     masks=image_record.get("mask_inputs", None),
                 )            
 
+            # image-level AMFG stage, shared by all the prompts of the record
+            robust_features = image_record.get("robust_features")
+            if robust_features is None:
+                robust_features = self.mask_decoder.get_robust_features(
+                    curr_embedding.unsqueeze(0), curr_encoder_features.unsqueeze(0), clear=False
+                )[0]
+
             low_res_masks, iou_predictions, robust_embeddings, robust_token = self.mask_decoder( 
                 image_embeddings=curr_embedding.unsqueeze(0),
                 image_pe=self.prompt_encoder.get_dense_pe(),
                 sparse_prompt_embeddings=sparse_embeddings,
                 dense_prompt_embeddings=dense_embeddings,
                 multimask_output=multimask_output,
-                encoder_features=curr_encoder_features.unsqueeze(0).unsqueeze(0),
                 robust_token_only=robust_token_only,
-                clear=False
+                clear=False,
+                robust_features=robust_features.unsqueeze(0),
             )            
             
             masks = self.postprocess_masks(
@@ -204,7 +251,8 @@ class Sam(nn.Module):
                     "iou_predictions": iou_predictions,
                     "low_res_logits": low_res_masks,
                     "robust_embeddings": robust_embeddings,
-                    "robust_token": robust_token
+                    "robust_token": robust_token,
+                    "robust_features": robust_features,
                 }
             )
 
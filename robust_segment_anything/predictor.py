@@ -87,6 +87,10 @@ class SamPredictor:
         self.input_size = tuple(transformed_image.shape[-2:])
         input_image = self.model.preprocess(transformed_image)
         self.features = self.model.image_encoder(input_image)
+        # prompt-independent part of the mask decoder, computed once per image
+        self.robust_features = self.model.mask_decoder.get_robust_features(
+            self.features[0], self.features[1][0]
+        )
         self.is_image_set = True
 
     def predict(
@@ -232,8 +236,8 @@ class SamPredictor:
             image_pe=self.model.prompt_encoder.get_dense_pe(),
             sparse_prompt_embeddings=sparse_embeddings,
             dense_prompt_embeddings=dense_embeddings,
-            encoder_features=self.features[1][0].unsqueeze(0),
-            multimask_output=multimask_output      
+            multimask_output=multimask_output,
+            robust_features=self.robust_features,
         )
         
         # Upscale the masks to the original image resolution
@@ -265,6 +269,7 @@ class SamPredictor:
         """Resets the currently set image."""
         self.is_image_set = False
         self.features = None
+        self.robust_features = None
         self.orig_h = None
         self.orig_w = None
         self.input_h = None
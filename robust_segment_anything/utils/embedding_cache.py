@@ -0,0 +1,164 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+_EMBEDDING_SUFFIX = ".emb.npy"
+_FEATURES_SUFFIX = ".feat.npy"
+
+
+def file_digest(path: str, chunk_size: int = 1 << 24) -> str:
+    """Returns the SHA-1 hex digest of a file, read in chunks."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_digest(image: np.ndarray) -> str:
+    """Returns the SHA-1 hex digest of a decoded image's pixels and shape."""
+    digest = hashlib.sha1(str(image.shape).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    An on-disk, content-addressed cache of image encoder outputs.
+
+    Each entry stores the neck output (CxHxW, 256x64x64 for SAM) and the first
+    global-attention feature map consumed by the mask decoder (HxWxC,
+    64x64x1024 for ViT-L) as two .npy files, which are memory-mapped on load.
+    Keys combine the image content hash with the checkpoint hash, so a new
+    checkpoint never reads stale embeddings. The total size on disk is capped
+    and the least recently used entries are evicted first; recency survives
+    restarts through the files' modification times.
+    """
+
+    def __init__(self, cache_dir: str, checkpoint_digest: str, max_bytes: int) -> None:
+        """
+        Arguments:
+          cache_dir (str): Directory holding the cached embeddings.
+          checkpoint_digest (str): Hash of the model checkpoint, e.g. from
+            file_digest(checkpoint_path).
+          max_bytes (int): Maximum total size of the cache on disk.
+        """
+        self.cache_dir = cache_dir
+        self.checkpoint_digest = checkpoint_digest
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._load_index()
+
+    def key(self, image: np.ndarray) -> str:
+        """Returns the cache key of a decoded HxWxC image."""
+        return hashlib.sha1((self.checkpoint_digest + image_digest(image)).encode()).hexdigest()
+
+    def get(self, key: str, device: Optional[torch.device] = None) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns (image_embeddings, encoder_features) for a key, or None on a
+        miss. The arrays are memory-mapped and only copied when moved to
+        'device'.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        embedding_path, features_path = self._paths(key)
+        try:
+            # copy-on-write mapping: pages are read lazily, the file is never modified
+            embedding = np.load(embedding_path, mmap_mode="c")
+            features = np.load(features_path, mmap_mode="c")
+            os.utime(embedding_path)
+        except (OSError, ValueError):
+            # evicted by another process or partially written, treat as a miss
+            with self._lock:
+                self._forget(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return torch.from_numpy(embedding).to(device), torch.from_numpy(features).to(device)
+
+    def put(self, key: str, image_embeddings: torch.Tensor, encoder_features: torch.Tensor) -> None:
+        """Stores the encoder outputs of one image and evicts old entries if needed."""
+        embedding_path, features_path = self._paths(key)
+        size = 0
+        for path, tensor in ((embedding_path, image_embeddings), (features_path, encoder_features)):
+            array = tensor.detach().float().cpu().numpy()
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+            size += os.path.getsize(path)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)))
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        prefix = os.path.join(self.cache_dir, key)
+        return prefix + _EMBEDDING_SUFFIX, prefix + _FEATURES_SUFFIX
+
+    def _load_index(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(_EMBEDDING_SUFFIX):
+                continue
+            key = name[: -len(_EMBEDDING_SUFFIX)]
+            embedding_path, features_path = self._paths(key)
+            if not os.path.exists(features_path):
+                continue
+            stat = os.stat(embedding_path)
+            entries.append((stat.st_mtime, key, stat.st_size + os.path.getsize(features_path)))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._evict(next(iter(self._entries)))
+
+    def _forget(self, key: str) -> None:
+        if key in self._entries:
+            self._total_bytes -= self._entries.pop(key)
+
+    def _evict(self, key: str) -> None:
+        self._forget(key)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
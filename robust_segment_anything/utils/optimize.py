@@ -0,0 +1,136 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+import copy
+
+from ..modeling import Sam
+from ..modeling.components import SelectiveConv, TokenBlock
+
+# Decoder modules that only run for one value of 'clear'
+_CLEAR_ONLY = ("mask_tokens", "output_hypernetworks_mlps")
+_ROBUST_ONLY = ("custom_robust_token", "robust_mlp", "custom_token_block")
+# Parts of the AMFG blocks that only run when clear=False
+_AMFG_BLOCKS = ("fourier_mask_features", "fourier_first_layer_features", "fourier_last_layer_features")
+_AMFG_ROBUST_ONLY = ("dnc_block_combined", "fgm_block", "conv_layer")
+
+
+class FoldedSelectiveConv(nn.Module):
+    """
+    Inference version of a SelectiveConv with first=False. The eval-mode
+    BatchNorm becomes a per-channel scale and shift, applied together with
+    the LeakyReLU; the instance norm runs functionally. Neither branch
+    clones the input, since both normalizations are out of place.
+    """
+
+    def __init__(self, module: SelectiveConv) -> None:
+        super().__init__()
+        self.conv1 = module.conv1
+        self.conv2 = module.conv2
+        self.selector = module.selector
+        self.negative_slope = module.relu.negative_slope
+        self.in_eps = module.IN.eps
+
+        bn = module.BN
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            shift = shift * bn.weight + bn.bias
+        self.register_buffer("bn_scale", scale.detach().view(1, -1, 1, 1))
+        self.register_buffer("bn_shift", shift.detach().view(1, -1, 1, 1))
+
+    @staticmethod
+    def can_fold(module: nn.Module) -> bool:
+        return (
+            isinstance(module, SelectiveConv)
+            and not module.first
+            and module.BN.track_running_stats
+            and module.BN.running_var is not None
+            and not module.IN.affine
+            and not module.IN.track_running_stats
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        f_input = F.leaky_relu(torch.addcmul(self.bn_shift, x, self.bn_scale), self.negative_slope, inplace=True)
+        s_input = F.leaky_relu(F.instance_norm(x, eps=self.in_eps), self.negative_slope, inplace=True)
+
+        out1 = self.conv1(f_input)
+        out2 = self.conv2(s_input)
+
+        att1, att2 = self.selector(out1 + out2)
+        return out1.mul_(att1).addcmul_(out2, att2)
+
+
+class DoubleInstanceNorm1d(nn.Module):
+    """
+    Two back-to-back non-affine InstanceNorm1d as a single one. With variance
+    v, norm(eps1) followed by norm(eps2) divides the centered input by
+    sqrt((1 + eps2) * v + eps1 * eps2), i.e. it is one norm with
+    eps = eps1 * eps2 / (1 + eps2), scaled by 1 / sqrt(1 + eps2).
+    """
+
+    def __init__(self, first: nn.InstanceNorm1d, second: nn.InstanceNorm1d) -> None:
+        super().__init__()
+        self.norm = nn.InstanceNorm1d(first.num_features, eps=first.eps * second.eps / (1 + second.eps))
+        self.scale = (1 + second.eps) ** -0.5
+
+    @staticmethod
+    def can_fuse(first: nn.Module, second: nn.Module) -> bool:
+        return all(
+            isinstance(norm, nn.InstanceNorm1d) and not norm.affine and not norm.track_running_stats
+            for norm in (first, second)
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.norm(x).mul_(self.scale)
+
+
+@torch.no_grad()
+def optimize_for_inference(sam: Sam, clear: bool = False, inplace: bool = False) -> Sam:
+    """
+    Rewrites a RobustSAM model for inference with a fixed 'clear' flag:
+    folds the eval-mode BatchNorm of every SelectiveConv into a per-channel
+    affine, drops its input clones, fuses the two InstanceNorms of the
+    TokenBlock, and strips the decoder modules that never run for 'clear'.
+    The outputs match the original model up to float rounding. The mask
+    decoder of the result raises if it is called with the other 'clear'.
+
+    Arguments:
+      sam (Sam): the model to optimize
+      clear (bool): the 'clear' flag the mask decoder will be called with,
+        False for Sam.predict and True for SamPredictor
+      inplace (bool): rewrite 'sam' itself instead of a copy
+
+    Returns:
+      (Sam): the optimized model, in eval mode
+    """
+    if not inplace:
+        sam = copy.deepcopy(sam)
+    sam.eval()
+    decoder = sam.mask_decoder
+
+    # strip what 'clear' makes unreachable before rewriting the rest
+    for name in _ROBUST_ONLY if clear else _CLEAR_ONLY:
+        setattr(decoder, name, None)
+    if clear:
+        for block in _AMFG_BLOCKS:
+            for name in _AMFG_ROBUST_ONLY:
+                setattr(getattr(decoder, block), name, None)
+    decoder.inference_clear = clear
+
+    for module in list(sam.modules()):
+        for name, child in module.named_children():
+            if FoldedSelectiveConv.can_fold(child):
+                setattr(module, name, FoldedSelectiveConv(child))
+        if isinstance(module, TokenBlock) and DoubleInstanceNorm1d.can_fuse(module.IN_layer_I, module.IN_layer_II):
+            module.IN_layer_I = DoubleInstanceNorm1d(module.IN_layer_I, module.IN_layer_II)
+            module.IN_layer_II = nn.Identity()
+
+    return sam